@@ -0,0 +1,79 @@
+"""
+Memory-mapped arrays keyed by annotation id.
+
+A store is a directory containing:
+    ids.npy         sorted annotation ids
+    <field>.npy     one array per field, row i belongs to ids[i]
+    texts.json      the raw refexps of each annotation, in the same order
+
+Fields are written with np.lib.format.open_memmap and read back with
+np.load(mmap_mode='r'), so opening a store costs nothing and rows are
+paged in on demand.
+"""
+import os
+import json
+import numpy as np
+
+
+class ArrayStoreWriter(object):
+    def __init__(self, directory, ids, fields):
+        """
+        fields maps each field name to its (row_shape, dtype)
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.ids = np.sort(np.asarray(ids, dtype=np.int64))
+        self.texts = [None] * len(self.ids)
+        self.fields = {}
+        for name, (shape, dtype) in fields.items():
+            filename = os.path.join(directory, '{}.npy'.format(name))
+            self.fields[name] = np.lib.format.open_memmap(
+                filename, mode='w+', dtype=dtype, shape=(len(self.ids),) + tuple(shape))
+
+    def write(self, annotation_id, texts, **values):
+        i = np.searchsorted(self.ids, annotation_id)
+        self.texts[i] = texts
+        for name, value in values.items():
+            self.fields[name][i] = value
+
+    def close(self):
+        for array in self.fields.values():
+            array.flush()
+        with open(os.path.join(self.directory, 'texts.json'), 'w') as fp:
+            json.dump(self.texts, fp)
+        # ids.npy is written last, so a partially written store is never readable
+        np.save(os.path.join(self.directory, 'ids.npy'), self.ids)
+
+
+class ArrayStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.ids = np.load(os.path.join(directory, 'ids.npy'))
+        with open(os.path.join(directory, 'texts.json')) as fp:
+            self.texts = json.load(fp)
+        self.fields = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, name):
+        if name not in self.fields:
+            filename = os.path.join(self.directory, '{}.npy'.format(name))
+            self.fields[name] = np.load(filename, mmap_mode='r')
+        return self.fields[name]
+
+    def field_names(self):
+        return sorted(f[:-len('.npy')] for f in os.listdir(self.directory)
+                if f.endswith('.npy') and f != 'ids.npy')
+
+    def image_fields(self):
+        # Global view fields first, then local view fields, as the model takes them
+        names = self.field_names()
+        return [n for n in names if n.startswith('global')] + [n for n in names if n.startswith('local')]
+
+    def position(self, annotation_id):
+        i = np.searchsorted(self.ids, annotation_id)
+        if i == len(self.ids) or self.ids[i] != annotation_id:
+            raise KeyError(annotation_id)
+        return i
@@ -0,0 +1,156 @@
+"""
+Multi-process batch producer.
+
+A pool of worker processes fills batches ahead of the training loop.
+Batches are built directly in shared memory slots (multiprocessing.RawArray
+viewed as NumPy arrays), so they are never pickled between processes:
+only slot numbers travel through the queues. Free slots go to the workers,
+filled slots come back to the consumer, which turns them into the arrays
+handed to the model and then returns the slot to the free queue.
+
+Stall times are tracked on both sides: the consumer waiting on an empty
+ready queue means the workers are too slow, workers waiting on an empty
+free queue means the model is.
+
+Workers must be forked: they inherit the shared slots from the parent
+rather than receiving them pickled. While waiting for a batch, the
+consumer checks that every worker is still alive, so a worker killed
+without a chance to report an error (eg. by the OOM killer) raises
+instead of hanging training.
+"""
+import os
+import time
+import queue
+import atexit
+import random
+import signal
+import traceback
+import multiprocessing
+import numpy as np
+
+# How often the consumer checks on the workers while waiting for a batch
+POLL_SECONDS = 1.0
+
+
+def shared_array(shape, dtype):
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    return np.frombuffer(multiprocessing.RawArray('b', size), dtype=dtype).reshape(shape)
+
+
+def copy_batch(arrays):
+    return [np.array(a) for a in arrays]
+
+
+class BatchProducer(object):
+    def __init__(self, fill_batch, specs, workers=4, slots=None, collect=copy_batch, worker_init=None, seed=None):
+        """
+        fill_batch(arrays): fills a list of arrays shaped like specs, in place, in a worker
+        specs: list of (shape, dtype), one for each array in a batch
+        collect(arrays): runs in the consumer and returns the batch to yield.
+            The arrays are reused as soon as it returns, so it must copy them.
+        worker_init(worker_id): runs once in each worker, eg. to open connections
+        seed: workers seed random and np.random with seed + worker_id
+        """
+        assert multiprocessing.get_start_method() == 'fork', \
+            "BatchProducer shares its slots with the workers through fork"
+        self.fill_batch = fill_batch
+        self.collect = collect
+        self.worker_init = worker_init
+        self.slots = [[shared_array(shape, dtype) for shape, dtype in specs]
+                for _ in range(slots or 2 * workers)]
+        self.free = multiprocessing.Queue()
+        self.ready = multiprocessing.Queue()
+        for slot in range(len(self.slots)):
+            self.free.put(slot)
+        self.stopping = multiprocessing.Event()
+        self.producer_stall = multiprocessing.Value('d', 0.0)
+        self.consumer_stall = 0.0
+        self.batches = 0
+        self.started = time.time()
+        self.workers = []
+        for worker_id in range(workers):
+            worker_seed = None if seed is None else seed + worker_id
+            process = multiprocessing.Process(target=self.work, args=(worker_id, worker_seed))
+            process.daemon = True
+            process.start()
+            self.workers.append(process)
+        atexit.register(self.close)
+
+    def work(self, worker_id, seed):
+        # The parent handles Ctrl-C and shuts the workers down
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Forked workers inherit the parent's RNG state, so always reseed
+        if seed is None:
+            seed = int.from_bytes(os.urandom(4), 'little')
+        random.seed(seed)
+        np.random.seed(seed % 2**32)
+        if self.worker_init:
+            self.worker_init(worker_id)
+        while not self.stopping.is_set():
+            start = time.time()
+            try:
+                slot = self.free.get(timeout=.1)
+            except queue.Empty:
+                slot = None
+            with self.producer_stall.get_lock():
+                self.producer_stall.value += time.time() - start
+            if slot is None:
+                continue
+            try:
+                self.fill_batch(self.slots[slot])
+            except Exception:
+                self.ready.put((slot, traceback.format_exc()))
+                return
+            self.ready.put((slot, None))
+        # Don't block exit on batches the consumer will never collect
+        self.ready.cancel_join_thread()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        while True:
+            try:
+                slot, error = self.ready.get(timeout=POLL_SECONDS)
+                break
+            except queue.Empty:
+                dead = [p for p in self.workers if not p.is_alive()]
+                if dead:
+                    self.close()
+                    raise RuntimeError("Batch producer worker died: {}".format(
+                        ', '.join('pid {} exit code {}'.format(p.pid, p.exitcode) for p in dead)))
+        self.consumer_stall += time.time() - start
+        if error is not None:
+            self.close()
+            raise RuntimeError("Batch producer worker failed:\n{}".format(error))
+        batch = self.collect(self.slots[slot])
+        self.free.put(slot)
+        self.batches += 1
+        return batch
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'elapsed': time.time() - self.started,
+            'consumer_stall': self.consumer_stall,
+            'producer_stall': self.producer_stall.value / max(len(self.workers), 1),
+        }
+
+    def report(self):
+        stats = self.stats()
+        return ("{batches} batches in {elapsed:.1f}s: consumer waited {consumer_stall:.1f}s, "
+                "each producer waited {producer_stall:.1f}s on average").format(**stats)
+
+    def close(self):
+        # atexit holds a reference to the producer and its shared slots until this is called
+        atexit.unregister(self.close)
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        for process in self.workers:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
@@ -17,6 +17,7 @@ cook_test(test, refs, n=4): Transform a test sentence as a string (together with
 '''
 
 import copy
+import numpy as np
 import sys, math, re
 from collections import defaultdict
 
@@ -26,8 +27,8 @@ def precook(s, n=4, out=False):
     can take string arguments as well."""
     words = s.split()
     counts = defaultdict(int)
-    for k in xrange(1,n+1):
-        for i in xrange(len(words)-k+1):
+    for k in range(1,n+1):
+        for i in range(len(words)-k+1):
             ngram = tuple(words[i:i+k])
             counts[ngram] += 1
     return (len(words), counts)
@@ -42,7 +43,7 @@ def cook_refs(refs, eff=None, n=4): ## lhuang: oracle will call with "average"
     for ref in refs:
         rl, counts = precook(ref, n)
         reflen.append(rl)
-        for (ngram,count) in counts.iteritems():
+        for (ngram,count) in counts.items():
             maxcounts[ngram] = max(maxcounts.get(ngram,0), count)
 
     # Calculate effective reference sentence length.
@@ -57,10 +58,11 @@ def cook_refs(refs, eff=None, n=4): ## lhuang: oracle will call with "average"
 
     return (reflen, maxcounts)
 
-def cook_test(test, (reflen, refmaxcounts), eff=None, n=4):
+def cook_test(test, cooked_refs, eff=None, n=4):
     '''Takes a test sentence and returns an object that
     encapsulates everything that BLEU needs to know about it.'''
 
+    reflen, refmaxcounts = cooked_refs
     testlen, counts = precook(test, n, True)
 
     result = {}
@@ -74,10 +76,10 @@ def cook_test(test, (reflen, refmaxcounts), eff=None, n=4):
 
     result["testlen"] = testlen
 
-    result["guess"] = [max(0,testlen-k+1) for k in xrange(1,n+1)]
+    result["guess"] = [max(0,testlen-k+1) for k in range(1,n+1)]
 
     result['correct'] = [0]*n
-    for (ngram, count) in counts.iteritems():
+    for (ngram, count) in counts.items():
         result["correct"][len(ngram)-1] += min(refmaxcounts.get(ngram,0), count)
 
     return result
@@ -224,40 +226,231 @@ class BleuScorer(object):
             self._reflen += reflen
                 
             for key in ['guess','correct']:
-                for k in xrange(n):
+                for k in range(n):
                     totalcomps[key][k] += comps[key][k]
 
             # append per image bleu score
             bleu = 1.
-            for k in xrange(n):
+            for k in range(n):
                 bleu *= (float(comps['correct'][k]) + tiny) \
                         /(float(comps['guess'][k]) + small) 
                 bleu_list[k].append(bleu ** (1./(k+1)))
             ratio = (testlen + tiny) / (reflen + small) ## N.B.: avoid zero division
             if ratio < 1:
-                for k in xrange(n):
+                for k in range(n):
                     bleu_list[k][-1] *= math.exp(1 - 1/ratio)
 
             if verbose > 1:
-                print comps, reflen
+                print(comps, reflen)
 
         totalcomps['reflen'] = self._reflen
         totalcomps['testlen'] = self._testlen
 
         bleus = []
         bleu = 1.
-        for k in xrange(n):
+        for k in range(n):
             bleu *= float(totalcomps['correct'][k] + tiny) \
                     / (totalcomps['guess'][k] + small)
             bleus.append(bleu ** (1./(k+1)))
         ratio = (self._testlen + tiny) / (self._reflen + small) ## N.B.: avoid zero division
         if ratio < 1:
-            for k in xrange(n):
+            for k in range(n):
                 bleus[k] *= math.exp(1 - 1/ratio)
 
         if verbose > 0:
-            print totalcomps
-            print "ratio:", ratio
+            print(totalcomps)
+            print("ratio:", ratio)
 
         self._score = bleus
         return self._score, bleu_list
+
+
+def _ngram_counts(ids, n, base):
+    '''Counts the n-grams of each row of ids, a 2d array of word ids padded
+    with -1. Every n-gram of up to n words is interned as the integer code
+    (word ids in base `base`) * n + (length - 1).
+    Returns arrays (rows, codes, counts), one entry per distinct n-gram of a row.'''
+    rows, codes = [], []
+    length = ids.shape[1]
+    for k in range(1, n+1):
+        if length < k:
+            break
+        code = np.zeros((ids.shape[0], length-k+1), dtype=np.int64)
+        valid = np.ones(code.shape, dtype=bool)
+        for j in range(k):
+            window = ids[:, j:length-k+1+j]
+            code = code * base + window
+            valid &= window >= 0
+        row, col = np.nonzero(valid)
+        rows.append(row)
+        codes.append(code[row, col] * n + (k-1))
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rows, codes = np.concatenate(rows), np.concatenate(codes)
+    order = np.lexsort((codes, rows))
+    rows, codes = rows[order], codes[order]
+    starts = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]) | (codes[1:] != codes[:-1])])
+    counts = np.diff(np.r_[starts, len(rows)])
+    return rows[starts], codes[starts], counts
+
+
+class CookedRefs(object):
+    """The references of one segment, cooked once so that any number of test
+    sentences can be scored against them in a batch.
+
+    Equivalent to cook_refs/cook_test, but words are interned as their index
+    in the words vocabulary (words not in it get ids local to the segment),
+    n-grams as integer codes, and clipped counts are computed in NumPy.
+    """
+
+    def __init__(self, refs, n=4):
+        import words
+        self.n = n
+        self.vocab = words.vocabulary.ids
+        self.vocab_size = words.VOCABULARY_SIZE
+        self.local = {}
+        ids = self.encode(refs, add_unknown=True)
+        # Test words that are in neither the vocabulary nor the refs all get the
+        # id base - 1, which is in no reference n-gram
+        self.base = self.vocab_size + len(self.local) + 1
+        assert self.base ** n * n < 2**63, "Too many n-grams to intern as int64"
+        self.reflens = np.array([len(ref.split()) for ref in refs])
+        rows, codes, counts = _ngram_counts(ids, n, self.base)
+        order = np.argsort(codes, kind='mergesort')
+        codes, counts = codes[order], counts[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.zeros(0, dtype=int)
+        self.codes = codes[starts]
+        self.maxcounts = np.maximum.reduceat(counts, starts) if len(codes) else counts
+
+    def word_id(self, word, add_unknown=False):
+        if word in self.vocab:
+            return self.vocab[word]
+        if add_unknown and word not in self.local:
+            self.local[word] = self.vocab_size + len(self.local)
+        return self.local.get(word, -2)
+
+    def encode(self, sentences, add_unknown=False):
+        tokens = [s.split() for s in sentences]
+        ids = -np.ones((len(tokens), max([len(t) for t in tokens] + [0])), dtype=np.int64)
+        for i, t in enumerate(tokens):
+            ids[i, :len(t)] = [self.word_id(w, add_unknown) for w in t]
+        return ids
+
+    def cook_tests(self, tests):
+        '''Like cook_test for each test sentence.
+        Returns a dict of arrays with one row per test: testlen, guess and correct'''
+        n = self.n
+        ids = self.encode(tests)
+        ids[ids == -2] = self.base - 1
+        testlen = (ids >= 0).sum(axis=1)
+        guess = np.maximum(0, testlen[:, None] - np.arange(n)[None, :])
+        correct = np.zeros((len(tests), n), dtype=np.int64)
+        rows, codes, counts = _ngram_counts(ids, n, self.base)
+        if len(self.codes):
+            found = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+            matches = self.codes[found] == codes
+            clipped = np.where(matches, np.minimum(counts, self.maxcounts[found]), 0)
+            np.add.at(correct, (rows, codes % n), clipped)
+        return {'testlen': testlen, 'guess': guess, 'correct': correct}
+
+    def reflen(self, testlen, option="closest"):
+        '''Like BleuScorer._single_reflen for each test length'''
+        if option == "shortest":
+            return np.full(len(testlen), self.reflens.min())
+        elif option == "average":
+            return np.full(len(testlen), float(self.reflens.sum())/len(self.reflens))
+        elif option == "closest":
+            # Ties go to the shorter reference
+            reflens = np.sort(self.reflens)
+            return reflens[np.argmin(np.abs(reflens[None, :] - testlen[:, None]), axis=1)]
+        assert False, "unsupported reflen option %s" % option
+
+    def score(self, tests, option="closest"):
+        '''BLEU-1 to BLEU-n of each test sentence on its own, which is
+        BleuScorer(test, refs).compute_score(option)[0] for each test.
+        Returns an array with one row per test'''
+        comps = self.cook_tests(tests)
+        comps['reflen'] = self.reflen(comps['testlen'], option)
+        return compute_scores(comps, self.n)[1].T
+
+
+def compute_scores(comps, n=4):
+    '''Like BleuScorer.compute_score, for comps with one row per sentence in each
+    of the arrays testlen, reflen, guess and correct (see CookedRefs.cook_tests),
+    concatenated over any number of segments.
+    Returns (corpus bleus, array of per sentence bleus with one row per order)'''
+    small = 1e-9
+    tiny = 1e-15 ## so that if guess is 0 still return 0
+    orders = 1. / np.arange(1, n+1)
+    guess = comps['guess'][:, :n].astype(float)
+    correct = comps['correct'][:, :n].astype(float)
+    testlen = np.asarray(comps['testlen'], dtype=float)
+    reflen = np.asarray(comps['reflen'], dtype=float)
+
+    bleu_list = np.cumprod((correct + tiny) / (guess + small), axis=1) ** orders
+    ratio = (testlen + tiny) / (reflen + small) ## N.B.: avoid zero division
+    brevity = np.where(ratio < 1, np.exp(1 - 1/ratio), 1.)
+    bleu_list = (bleu_list * brevity[:, None]).T
+
+    bleus = np.cumprod((correct.sum(axis=0) + tiny) / (guess.sum(axis=0) + small)) ** orders
+    ratio = (testlen.sum() + tiny) / (reflen.sum() + small)
+    if ratio < 1:
+        bleus *= math.exp(1 - 1/ratio)
+    return list(bleus), bleu_list
+
+
+def test_cooked_refs():
+    '''CookedRefs must match BleuScorer'''
+    refs = ['the man on the left', 'a man in a red shirt', 'man left of the zebra xylophone']
+    tests = ['the man on the left', 'man', '', 'a red red red shirt', 'zebra xylophone on the left side',
+             'unknownword the man', 'the the the the the the the']
+    cooked = CookedRefs(refs, n=4)
+    for option in ["closest", "shortest", "average"]:
+        batch = cooked.score(tests, option)
+        for test, row in zip(tests, batch):
+            expected, _ = BleuScorer(test, refs, n=4).compute_score(option=option)
+            assert np.allclose(row, expected, rtol=1e-12, atol=0), (test, row, expected)
+
+    comps = cooked.cook_tests(tests)
+    comps['reflen'] = cooked.reflen(comps['testlen'])
+    corpus = BleuScorer(n=4)
+    for test in tests:
+        corpus += (test, refs)
+    expected, expected_list = corpus.compute_score(option="closest")
+    bleus, bleu_list = compute_scores(comps, 4)
+    assert np.allclose(bleus, expected, rtol=1e-12, atol=0), (bleus, expected)
+    assert np.allclose(bleu_list, expected_list, rtol=1e-12, atol=0)
+    print("CookedRefs tests complete!")
+
+
+# BLEU-1 and BLEU-2 as computed by caption.bleu, and the corpus BLEU-1 to BLEU-4
+# of all of them, recorded with the original Python 2 scorer
+PINNED_REFS = ['the man on the left', 'a man in a red shirt', 'man left of the zebra']
+PINNED_SCORES = [
+    ('the man on the left', [0.9999999996000004, 0.9999999995750004]),
+    ('man in red', [0.5134171186903144, 0.36304072617292654]),
+    ('', [0.0, 0.0]),
+    ('a red red red shirt', [0.5999999997600003, 0.5477225572723844]),
+    ('the zebra on the left side', [0.8333333330555557, 0.7071067809390603]),
+    ('giraffe', [1.8315638852103013e-17, 5.791913560267694e-13]),
+]
+PINNED_CORPUS_SCORES = [0.4615598482582334, 0.4213445675459821, 0.3339591750653369, 0.2799223221940529]
+
+
+def test_pinned_scores():
+    corpus = BleuScorer(n=4)
+    tests = [test for test, expected in PINNED_SCORES]
+    batch = CookedRefs(PINNED_REFS, n=2).score(tests)
+    for (test, expected), row in zip(PINNED_SCORES, batch):
+        scores, _ = BleuScorer(test, PINNED_REFS, n=2).compute_score(option='closest')
+        assert np.allclose(scores, expected, rtol=1e-12, atol=0), (test, scores, expected)
+        assert np.allclose(row, expected, rtol=1e-12, atol=0), (test, row, expected)
+        corpus += (test, PINNED_REFS)
+    scores, _ = corpus.compute_score(option='closest')
+    assert np.allclose(scores, PINNED_CORPUS_SCORES, rtol=1e-12, atol=0), scores
+    print("Pinned BLEU tests complete!")
+
+
+if __name__ == '__main__':
+    test_cooked_refs()
+    test_pinned_scores()
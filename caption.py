@@ -4,19 +4,30 @@ import random
 import re
 import sys
 import time
-from keras import models, layers
-from PIL import Image
-from StringIO import StringIO
+import weakref
+import functools
 
-from keras.applications import resnet50
-import tensorflow as tf
 import words
+import array_store
+import datastore
+import batch_producer
 import dataset_grefexp
 import bleu_scorer
 import rouge_scorer
 import util
 from util import MAX_WORDS
 
+# Keras and TensorFlow take seconds to import, so they are only imported
+# when the first model is built: scoring, data loading and worker
+# processes never pay for them
+models = util.LazyModule('keras.models')
+layers = util.LazyModule('keras.layers')
+optimizers = util.LazyModule('keras.optimizers')
+K = util.LazyModule('keras.backend')
+resnet50 = util.LazyModule('keras.applications.resnet50')
+tf = util.LazyModule('tensorflow')
+rewriter_config_pb2 = util.LazyModule('tensorflow.core.protobuf.rewriter_config_pb2')
+
 IMG_WIDTH = 224
 IMG_HEIGHT = 224
 IMG_CHANNELS = 3
@@ -26,42 +37,70 @@ IMG_SHAPE = (IMG_HEIGHT, IMG_WIDTH, IMG_CHANNELS)
 LEARNABLE_RESNET_LAYERS = 7
 
 def build_model(GRU_SIZE=1024, WORDVEC_SIZE=300, ACTIVATION='relu'):
+    use_graph_mode()
     resnet = build_resnet()
+    model_layers = build_layers(GRU_SIZE, WORDVEC_SIZE, ACTIVATION)
 
     # Global Image featuers (convnet output for the whole image)
     input_img_global = layers.Input(shape=IMG_SHAPE)
-    image_global = resnet(input_img_global)
-    image_global = layers.BatchNormalization()(image_global)
-    image_global = layers.Dense(WORDVEC_SIZE/2, activation=ACTIVATION)(image_global)
-    image_global = layers.BatchNormalization()(image_global)
-    image_global = layers.RepeatVector(MAX_WORDS)(image_global)
-
-
     # Local Image features (convnet output inside the bounding box)
     input_img_local = layers.Input(shape=IMG_SHAPE)
-    image_local = resnet(input_img_local)
-    image_local = layers.BatchNormalization()(image_local)
-    image_local = layers.Dense(WORDVEC_SIZE/2, activation=ACTIVATION)(image_local)
-    image_local = layers.BatchNormalization()(image_local)
-    image_local = layers.RepeatVector(MAX_WORDS)(image_local)
-
-
     # Context Vector input
     # normalized to [0,1] the values:
     # left, top, right, bottom, (box area / image area)
     input_ctx = layers.Input(shape=(5,))
-    ctx = layers.BatchNormalization()(input_ctx)
-    ctx = layers.RepeatVector(MAX_WORDS)(ctx)
+    input_words = layers.Input(shape=(MAX_WORDS,), dtype='int32')
 
-    language_model = models.Sequential()
+    x = connect_layers(model_layers, resnet(input_img_global), resnet(input_img_local), input_words, input_ctx)
+    return models.Model(inputs=[input_img_global, input_img_local, input_words, input_ctx], outputs=x)
 
-    input_words = layers.Input(shape=(MAX_WORDS,), dtype='int32')
-    language = layers.Embedding(words.VOCABULARY_SIZE, WORDVEC_SIZE, input_length=MAX_WORDS)(input_words)
-    language = layers.BatchNormalization()(language)
-    language = layers.GRU(GRU_SIZE, return_sequences=True)(language)
-    language = layers.BatchNormalization()(language)
-    language = layers.TimeDistributed(layers.Dense(WORDVEC_SIZE, activation=ACTIVATION))(language)
-    language = layers.BatchNormalization()(language)
+
+def build_layers(GRU_SIZE=1024, WORDVEC_SIZE=300, ACTIVATION='relu'):
+    # Named, so that variants of the model can be built around the same layers
+    return {
+        'image_global_bn': layers.BatchNormalization(name='image_global_bn'),
+        'image_global_dense': layers.Dense(WORDVEC_SIZE//2, activation=ACTIVATION, name='image_global_dense'),
+        'image_global_dense_bn': layers.BatchNormalization(name='image_global_dense_bn'),
+        'image_local_bn': layers.BatchNormalization(name='image_local_bn'),
+        'image_local_dense': layers.Dense(WORDVEC_SIZE//2, activation=ACTIVATION, name='image_local_dense'),
+        'image_local_dense_bn': layers.BatchNormalization(name='image_local_dense_bn'),
+        'ctx_bn': layers.BatchNormalization(name='ctx_bn'),
+        'word_embedding': layers.Embedding(words.VOCABULARY_SIZE, WORDVEC_SIZE, input_length=MAX_WORDS, name='word_embedding'),
+        'word_bn': layers.BatchNormalization(name='word_bn'),
+        'language_gru': layers.GRU(GRU_SIZE, return_sequences=True, name='language_gru'),
+        'language_gru_bn': layers.BatchNormalization(name='language_gru_bn'),
+        'language_dense': layers.TimeDistributed(layers.Dense(WORDVEC_SIZE, activation=ACTIVATION), name='language_dense'),
+        'language_dense_bn': layers.BatchNormalization(name='language_dense_bn'),
+        'caption_gru': layers.GRU(GRU_SIZE, name='caption_gru'),
+        'caption_gru_bn': layers.BatchNormalization(name='caption_gru_bn'),
+        'caption_softmax': layers.Dense(words.VOCABULARY_SIZE, activation='softmax', name='caption_softmax'),
+    }
+
+
+def get_layers(model):
+    return {layer.name: layer for layer in model.layers}
+
+
+def connect_layers(l, image_global, image_local, input_words, input_ctx):
+    image_global = l['image_global_bn'](image_global)
+    image_global = l['image_global_dense'](image_global)
+    image_global = l['image_global_dense_bn'](image_global)
+    image_global = layers.RepeatVector(MAX_WORDS)(image_global)
+
+    image_local = l['image_local_bn'](image_local)
+    image_local = l['image_local_dense'](image_local)
+    image_local = l['image_local_dense_bn'](image_local)
+    image_local = layers.RepeatVector(MAX_WORDS)(image_local)
+
+    ctx = l['ctx_bn'](input_ctx)
+    ctx = layers.RepeatVector(MAX_WORDS)(ctx)
+
+    language = l['word_embedding'](input_words)
+    language = l['word_bn'](language)
+    language = l['language_gru'](language)
+    language = l['language_gru_bn'](language)
+    language = l['language_dense'](language)
+    language = l['language_dense_bn'](language)
 
     # Problem with Keras 2: 
     # TypeError: Tensors in list passed to 'values' of 'ConcatV2' Op have types [uint8, uint8, bool, uint8] that don't all match.
@@ -69,11 +108,10 @@ def build_model(GRU_SIZE=1024, WORDVEC_SIZE=300, ACTIVATION='relu'):
     # How do I get mask_zero=True working in the embed layer?
 
     x = layers.concatenate([image_global, image_local, ctx, language])
-    x = layers.GRU(GRU_SIZE)(x)
-    x = layers.BatchNormalization()(x)
-    x = layers.Dense(words.VOCABULARY_SIZE, activation='softmax')(x)
-
-    return models.Model(inputs=[input_img_global, input_img_local, input_words, input_ctx], outputs=x)
+    x = l['caption_gru'](x)
+    x = l['caption_gru_bn'](x)
+    x = l['caption_softmax'](x)
+    return x
 
 
 def build_resnet():
@@ -83,39 +121,313 @@ def build_resnet():
     return resnet
 
 
+def inbound_node(layer):
+    # The node created when the ResNet was built: (inbound layers, input tensors, output tensor)
+    node = (getattr(layer, '_inbound_nodes', None) or layer.inbound_nodes)[0]
+    as_list = lambda x: x if isinstance(x, (list, tuple)) else [x]
+    return as_list(node.inbound_layers), as_list(node.input_tensors), as_list(node.output_tensors)[0]
+
+
+def split_resnet(resnet):
+    """
+    Splits the ResNet at LEARNABLE_RESNET_LAYERS into a frozen trunk and a
+    learnable head. The trunk outputs every frozen activation that a
+    learnable layer consumes, and the head maps those back to the ResNet
+    output. Both reuse the ResNet's own layers, so they share its weights.
+    """
+    frozen = set(layer.name for layer in resnet.layers[:-LEARNABLE_RESNET_LAYERS])
+    learnable = resnet.layers[-LEARNABLE_RESNET_LAYERS:]
+    boundary = []
+    for layer in learnable:
+        inbound_layers, input_tensors, _ = inbound_node(layer)
+        for inbound_layer, tensor in zip(inbound_layers, input_tensors):
+            if inbound_layer.name in frozen and tensor.name not in [t.name for t in boundary]:
+                boundary.append(tensor)
+    trunk = models.Model(inputs=resnet.inputs, outputs=boundary)
+
+    head_inputs = [layers.Input(shape=K.int_shape(t)[1:]) for t in boundary]
+    tensors = {t.name: i for t, i in zip(boundary, head_inputs)}
+    for layer in learnable:
+        _, input_tensors, output_tensor = inbound_node(layer)
+        inputs = [tensors[t.name] for t in input_tensors]
+        tensors[output_tensor.name] = layer(inputs[0] if len(inputs) == 1 else inputs)
+    head = models.Model(inputs=head_inputs, outputs=tensors[resnet.outputs[0].name])
+    return trunk, head
+
+
+def build_feature_model(model):
+    """
+    Returns (trunk, feature_model) for a model from build_model.
+    trunk computes the frozen ResNet activations of an image. feature_model
+    takes those activations for the global and local views in place of the
+    images and only runs the learnable part. All layers are shared with model,
+    so training feature_model trains model.
+    """
+    trunk, head = split_resnet(model.get_layer('resnet50'))
+    inputs_global = [layers.Input(shape=K.int_shape(t)[1:]) for t in trunk.outputs]
+    inputs_local = [layers.Input(shape=K.int_shape(t)[1:]) for t in trunk.outputs]
+    input_words = layers.Input(shape=(MAX_WORDS,), dtype='int32')
+    input_ctx = layers.Input(shape=(5,))
+    x = connect_layers(get_layers(model), head(inputs_global), head(inputs_local), input_words, input_ctx)
+    feature_model = models.Model(inputs=inputs_global + inputs_local + [input_words, input_ctx], outputs=x)
+    # Remember the graph and session, since the training generator calls
+    # trunk.predict from another thread, and Keras keeps a session per thread
+    trunk.graph = tf.compat.v1.get_default_graph()
+    trunk.session = tf.compat.v1.keras.backend.get_session()
+    return trunk, feature_model
+
+
+PRECISIONS = ['float32', 'mixed_float16', 'mixed_bfloat16']
+
+# Kept in float32 by the mixed precision rewrite: the softmax over the whole
+# vocabulary and the log of its output in the loss, or the two fused
+FLOAT32_OPS = 'Softmax,Log,LogSoftmax,SoftmaxCrossEntropyWithLogits,SparseSoftmaxCrossEntropyWithLogits'
+
+
+def use_graph_mode():
+    # The models run as TF1-style graphs: one session, predict functions
+    # shared between threads. TensorFlow 2 runs them through tf.compat.v1
+    tf.compat.v1.disable_eager_execution()
+
+
+def configure_training(precision='float32', xla=False):
+    """
+    Starts the Keras session to train in, and returns the optimizer to compile with.
+    Call it before building the model. Needs TensorFlow 2.3 or later.
+
+    mixed_float16 and mixed_bfloat16 use TensorFlow's mixed precision graph
+    rewrite, which runs matmuls and convolutions in 16 bits and keeps the
+    weights, the softmax and the loss in float32. float16 needs a GPU, and
+    gets dynamic loss scaling so small gradients don't flush to zero.
+    bfloat16 is for CPUs (TensorFlow built with oneDNN, the default on x86
+    since 2.9), and has the range of float32, so it needs no loss scaling.
+    xla JIT-compiles the graph, including the train step, on CPU too.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("precision must be one of {}".format(PRECISIONS))
+    # The rewrite reads these when it first runs. An op may only be on one of its lists
+    os.environ['TF_AUTO_MIXED_PRECISION_GRAPH_REWRITE_INFERLIST_REMOVE'] = FLOAT32_OPS
+    os.environ['TF_AUTO_MIXED_PRECISION_GRAPH_REWRITE_DENYLIST_ADD'] = FLOAT32_OPS
+    if xla:
+        # Without this flag the global JIT level only applies to GPUs.
+        # XLA reads its flags once, so this has to happen before the first session
+        os.environ['TF_XLA_FLAGS'] = (os.environ.get('TF_XLA_FLAGS', '') + ' --tf_xla_cpu_global_jit').strip()
+    use_graph_mode()
+
+    # Adam with the Keras defaults, of the kind that runs in graph mode
+    optimizer = optimizers.get('adam')
+    # allow_soft_placement, like the session Keras would have created
+    config = tf.compat.v1.ConfigProto(allow_soft_placement=True)
+    rewrite = config.graph_options.rewrite_options
+    if precision == 'mixed_float16':
+        # Also turns the rewrite on for sessions created from now on
+        optimizer = tf.compat.v1.mixed_precision.enable_mixed_precision_graph_rewrite(optimizer, loss_scale='dynamic')
+    elif precision == 'mixed_bfloat16':
+        # Renamed in TensorFlow 2.9
+        fields = rewrite.DESCRIPTOR.fields_by_name
+        field = next((f for f in ['auto_mixed_precision_onednn_bfloat16', 'auto_mixed_precision_mkl'] if f in fields), None)
+        if field is None:
+            raise ValueError("mixed_bfloat16 needs TensorFlow 2.3 or later, built with oneDNN")
+        setattr(rewrite, field, rewriter_config_pb2.RewriterConfig.ON)
+    if xla:
+        config.graph_options.optimizer_options.global_jit_level = tf.compat.v1.OptimizerOptions.ON_1
+    tf.compat.v1.keras.backend.set_session(tf.compat.v1.Session(config=config))
+    return optimizer
+
+
+def target_batch(batch_size, sparse=False):
+    # Sparse targets are word indices, for the sparse_categorical_crossentropy loss
+    if sparse:
+        return np.zeros((batch_size, 1), dtype=util.INDEX_DTYPE)
+    return np.zeros((batch_size, words.VOCABULARY_SIZE), dtype=util.FLOAT_DTYPE)
+
+
+def set_target(Y, i, y):
+    if Y.shape[1] == 1:
+        Y[i] = y
+    else:
+        Y[i, y] = 1.0
+
+
+def training_batch_specs(batch_size, sparse=False):
+    # (shape, dtype) of X_global, X_local, X_words, X_ctx and Y
+    # Images are gathered as uint8 and converted to float32 once per batch
+    image_shape = (batch_size, IMG_HEIGHT, IMG_WIDTH, IMG_CHANNELS)
+    target = target_batch(1, sparse)
+    return [
+        (image_shape, util.PIXEL_DTYPE),
+        (image_shape, util.PIXEL_DTYPE),
+        ((batch_size, MAX_WORDS), util.INDEX_DTYPE),
+        ((batch_size, 5), util.FLOAT_DTYPE),
+        ((batch_size,) + target.shape[1:], target.dtype),
+    ]
+
+
+def fill_training_batch(arrays):
+    X_global, X_local, X_words, X_ctx, Y = arrays
+    Y[:] = 0
+    part, parts = training_part
+    for i, annotation in enumerate(dataset_grefexp.sequential_examples(len(Y), part=part, parts=parts)):
+        x, y = process(*annotation, normalize=False)
+        x_global, x_local, x_words, x_ctx = x
+        X_global[i] = x_global
+        X_local[i] = x_local
+        X_words[i] = x_words
+        X_ctx[i] = x_ctx
+        set_target(Y, i, y)
+
+
+def collect_training_batch(arrays):
+    # Preprocessing the images also copies them out of the batch buffers
+    X_global, X_local, X_words, X_ctx, Y = arrays
+    X_global = util.imagenet_process_batch(X_global)
+    X_local = util.imagenet_process_batch(X_local)
+    return [X_global, X_local, np.array(X_words), np.array(X_ctx)], np.array(Y)
+
+
+# The (part, parts) of the training set this process reads, see dataset_grefexp.sequential_examples
+training_part = (0, 1)
+
+
+def init_training_worker(worker_id, workers=1):
+    global training_part
+    training_part = (worker_id, workers)
+    dataset_grefexp.reconnect()
+
+
 # TODO: Move batching out to the generic runner
-def training_generator():
+# With workers > 0, batches are built ahead of time by a pool of processes
+def training_generator(sparse=False, workers=0):
+    BATCH_SIZE = 32
+    specs = training_batch_specs(BATCH_SIZE, sparse)
+    if workers == 0:
+        while True:
+            arrays = [np.zeros(shape, dtype=dtype) for shape, dtype in specs]
+            fill_training_batch(arrays)
+            yield collect_training_batch(arrays)
+    producer = batch_producer.BatchProducer(fill_training_batch, specs, workers=workers,
+            collect=collect_training_batch, worker_init=functools.partial(init_training_worker, workers=workers))
+    try:
+        for batch in producer:
+            if producer.batches % 100 == 0:
+                print(producer.report())
+            yield batch
+    finally:
+        producer.close()
+
+
+# Reads an ArrayStore built by preprocess.py: either uint8 crops for build_model,
+# or frozen ResNet activations for the feature_model from build_feature_model
+def cached_training_generator(store_dir, sparse=False):
+    store = array_store.ArrayStore(store_dir)
+    image_fields = store.image_fields()
+    # Strip and tokenize every refexp once, rather than once per sample
+    texts = [dataset_grefexp.refexps(t) for t in store.texts]
     while True:
         BATCH_SIZE = 32
-        X_global = np.zeros((BATCH_SIZE, IMG_HEIGHT, IMG_WIDTH, IMG_CHANNELS))
-        X_local = np.zeros((BATCH_SIZE, IMG_HEIGHT, IMG_WIDTH, IMG_CHANNELS))
-        X_words = np.zeros((BATCH_SIZE, MAX_WORDS), dtype=int)
-        X_ctx = np.zeros((BATCH_SIZE,5))
-        Y = np.zeros((BATCH_SIZE, words.VOCABULARY_SIZE))
-        for i in range(BATCH_SIZE):
-            x, y = process(*dataset_grefexp.example())
-            x_global, x_local, x_words, x_ctx = x
-            X_global[i] = x_global
-            X_local[i] = x_local
-            X_words[i] = x_words
-            X_ctx[i] = x_ctx
-            Y[i] = y
-        yield [X_global, X_local, X_words, X_ctx], Y
-
-
-def process(jpg_data, box, texts):
-    x_local = util.decode_jpg(jpg_data, crop_to_box=box)
+        # Sorted positions keep reads from the memory-mapped store in file order
+        positions = np.sort(np.random.randint(0, len(store), size=BATCH_SIZE))
+        X_images = [load_cached_images(store[name], positions) for name in image_fields]
+        X_words = np.zeros((BATCH_SIZE, MAX_WORDS), dtype=util.INDEX_DTYPE)
+        X_ctx = np.zeros((BATCH_SIZE,5), dtype=util.FLOAT_DTYPE)
+        Y = target_batch(BATCH_SIZE, sparse)
+        for i, position in enumerate(positions):
+            X_words[i], y = process_text(texts[position])
+            set_target(Y, i, y)
+            X_ctx[i] = img_ctx(store['box'][position])
+        yield X_images + [X_words, X_ctx], Y
+
+
+def load_cached_images(field, positions):
+    X = field[positions]
+    if X.dtype == util.PIXEL_DTYPE:
+        return util.imagenet_process_batch(X)
+    return X.astype(util.FLOAT_DTYPE)
+
+
+# Number of annotations whose rows are shuffled together in expanded batches
+EXPAND_ANNOTATIONS = 8
+
+
+def expanded_rows(trunk=None):
+    """
+    Yields (image_inputs, x_words, x_ctx, y) for every teacher-forced prefix
+    of every refexp of each sampled annotation, so the images of an
+    annotation are decoded once for all of its rows.
+    image_inputs is [x_global, x_local] as uint8, or with a trunk from
+    build_feature_model, the trunk activations of both views, computed
+    once per annotation.
+    """
+    while True:
+        processed = [process_all(*a, normalize=False) for a in dataset_grefexp.examples(EXPAND_ANNOTATIONS)]
+        images = [[x_global, x_local] for x_global, x_local, x_ctx, prefixes in processed]
+        if trunk is not None:
+            images = encode_images(trunk, images)
+        rows = []
+        for image_inputs, (x_global, x_local, x_ctx, prefixes) in zip(images, processed):
+            rows.extend((image_inputs, x_words, x_ctx, y) for x_words, y in prefixes)
+        random.shuffle(rows)
+        for row in rows:
+            yield row
+
+
+def encode_images(trunk, images):
+    # Runs the frozen trunk once over both views of every annotation
+    X = util.imagenet_process_batch(np.array([view for pair in images for view in pair]))
+    with trunk.graph.as_default(), trunk.session.as_default():
+        features = trunk.predict(X)
+    if not isinstance(features, list):
+        features = [features]
+    return [[f[2*i] for f in features] + [f[2*i + 1] for f in features] for i in range(len(images))]
+
+
+def expanded_training_generator(sparse=False, trunk=None):
+    # Batches for build_model, or for the feature_model that goes with trunk
+    BATCH_SIZE = 32
+    rows = expanded_rows(trunk)
+    while True:
+        batch = [next(rows) for _ in range(BATCH_SIZE)]
+        X_images = [np.array([row[0][j] for row in batch]) for j in range(len(batch[0][0]))]
+        if trunk is None:
+            X_images = [util.imagenet_process_batch(X) for X in X_images]
+        X_words = np.array([row[1] for row in batch], dtype=util.INDEX_DTYPE)
+        X_ctx = np.array([row[2] for row in batch], dtype=util.FLOAT_DTYPE)
+        Y = target_batch(BATCH_SIZE, sparse)
+        for i, row in enumerate(batch):
+            set_target(Y, i, row[3])
+        yield X_images + [X_words, X_ctx], Y
+
+
+def process_all(jpg_data, box, texts, normalize=True):
+    # Like process, but returns every (x_words, y) prefix of every text
+    x_global, x_local, box = util.decode_views(jpg_data, box, normalize)
+    x_ctx = img_ctx(box)
+    prefixes = []
+    for indices in dataset_grefexp.refexps(texts).tokens:
+        for idx in range(len(indices)):
+            prefixes.append((util.left_pad(indices[:idx][-MAX_WORDS:]), indices[idx]))
+    return x_global, x_local, x_ctx, prefixes
+
+
+# normalize=False returns uint8 images, for callers that preprocess a whole batch
+def process(jpg_data, box, texts, normalize=True):
     # hack: scale the box down
-    x_global, box = util.decode_jpg(jpg_data, box)
-    text = util.strip(random.choice(texts))
-    indices = words.indices(text)
-    idx = np.random.randint(0, len(indices))
-    x_words = util.left_pad(indices[:idx][-MAX_WORDS:])
-    y = util.onehot(indices[idx])
+    x_global, x_local, box = util.decode_views(jpg_data, box, normalize)
+    x_words, y = process_text(texts)
     x_ctx = img_ctx(box)
     return [x_global, x_local, x_words, x_ctx], y
 
 
+def process_text(texts):
+    # The refexp's tokens come precomputed with the record, see dataset_grefexp.Refexps
+    indices = random.choice(dataset_grefexp.refexps(texts).tokens)
+    idx = np.random.randint(0, len(indices))
+    x_words = util.left_pad(indices[:idx][-MAX_WORDS:])
+    # The target is the index of the next word, see target_batch
+    y = indices[idx]
+    return x_words, y
+
+
 def img_ctx(box):
     x0, x1, y0, y1 = box
     left = float(x0) / IMG_WIDTH
@@ -124,37 +436,131 @@ def img_ctx(box):
     bottom = float(y1) / IMG_HEIGHT
     box_area = float(x1 - x0) * (y1 - y0)
     img_area = IMG_HEIGHT * IMG_WIDTH
-    x_ctx = np.array([left, top, right, bottom, box_area/img_area])
+    x_ctx = np.array([left, top, right, bottom, box_area/img_area], dtype=util.FLOAT_DTYPE)
     return x_ctx
 
 
 def validation_generator():
-    for k in dataset_grefexp.get_all_keys():
+    for annotation_id, example in validation_examples():
+        yield example
+
+
+def validation_examples(shard=0, shards=1, done=()):
+    """
+    Yields (annotation id, example) for the val annotations of one shard,
+    in the fixed order of dataset_grefexp.get_all_keys, skipping the ids in done
+    """
+    for k in dataset_grefexp.get_all_keys()[shard::shards]:
+        annotation_id = int(k.split('_')[-1])
+        if annotation_id in done:
+            continue
         jpg_data, box, texts = dataset_grefexp.get_annotation_for_key(k)
         x, y = process(jpg_data, box, texts)
         x_global, x_local, x_words, x_ctx = x
-        yield x_global, x_local, x_ctx, box, texts
+        yield annotation_id, (x_global, x_local, x_ctx, box, texts)
+
+
+# Like validation_generator, for a store built by preprocess.py
+# With a feature store, x_global and x_local are lists of trunk activations
+def cached_validation_generator(store_dir):
+    for annotation_id, example in cached_validation_examples(store_dir):
+        yield example
+
+
+def cached_validation_examples(store_dir, shard=0, shards=1, done=()):
+    store = array_store.ArrayStore(store_dir)
+    image_fields = store.image_fields()
+    for position in range(shard, len(store), shards):
+        annotation_id = int(store.ids[position])
+        if annotation_id in done:
+            continue
+        images = [load_cached_images(store[name], [position])[0] for name in image_fields]
+        x_global, x_local = images[:len(images)//2], images[len(images)//2:]
+        if len(images) == 2:
+            x_global, x_local = x_global[0], x_local[0]
+        box = tuple(store['box'][position])
+        yield annotation_id, (x_global, x_local, img_ctx(box), box, dataset_grefexp.refexps(store.texts[position]))
+
+
+def evaluate(model, x_global, x_local, x_ctx, box, texts, temperature=.0, beam_width=0):
+    if beam_width:
+        candidate, likelihood = predict_beam(model, x_global, x_local, x_ctx, box, beam_width)
+    else:
+        candidate, likelihood = predict(model, x_global, x_local, x_ctx, box, temperature)
+    scores = score(candidate, likelihood, texts)
+    print("{} {} ({})".format(likelihood, scores['candidate'], dataset_grefexp.refexps(texts).stripped[0]))
+    return scores
 
 
-def evaluate(model, x_global, x_local, x_ctx, box, texts, temperature=.0):
-    candidate, likelihood = predict(model, x_global, x_local, x_ctx, box, temperature)
+def score(candidate, likelihood, texts):
     candidate = util.strip(candidate)
-    references = map(util.strip, texts)
-    print("{} {} ({})".format(likelihood, candidate, references[0]))
-    scores = {}
+    references = dataset_grefexp.refexps(texts).stripped
+    scores = {'candidate': candidate}
     scores['bleu1'], scores['bleu2'] = bleu(candidate, references)
     scores['rouge'] = rouge(candidate, references)
     scores['likelihood'] = likelihood
     return scores
 
 
+def score_all(results, texts):
+    # Scores a list of (candidate, likelihood) against the same references
+    candidates = [util.strip(candidate) for candidate, likelihood in results]
+    references = dataset_grefexp.refexps(texts).stripped
+    bleus = cook_references(references).score(candidates)
+    rouges = rouge_scorer.Rouge().calc_scores(candidates, references)
+    all_scores = []
+    for candidate, (_, likelihood), (bleu1, bleu2), rouge in zip(candidates, results, bleus, rouges):
+        all_scores.append({'candidate': candidate, 'bleu1': bleu1, 'bleu2': bleu2, 'rouge': rouge, 'likelihood': likelihood})
+    return all_scores
+
+
+# The temperatures evaluate.py samples captions at, 0 being the greedy caption
+SAMPLE_TEMPERATURES = [.1 * i for i in range(10)]
+
+
+def evaluate_batch(model, examples, temperatures=SAMPLE_TEMPERATURES, beam_width=0):
+    """
+    Captions a batch of examples from validation_generator at every temperature,
+    plus a beam search if beam_width is set, all in batched decodes.
+    Returns one list of (candidate, likelihood) per example, in temperature order
+    """
+    x_images = [np.stack(x) for x in zip(*[util.as_list(e[0]) + util.as_list(e[1]) for e in examples])]
+    x_ctx = np.stack([e[2] for e in examples])
+    decoder = get_decoder(model)
+    rows = len(temperatures)
+    candidates, likelihoods = decoder.decode(x_images, x_ctx, np.tile(temperatures, len(examples)), rows)
+    results = list(zip(candidates, likelihoods))
+    results = [results[i * rows:(i + 1) * rows] for i in range(len(examples))]
+    if beam_width:
+        candidates, beam_scores = decoder.beam_search(x_images, x_ctx, beam_width)
+        for r, candidate, beam_score in zip(results, candidates, beam_scores):
+            r.append((candidate, beam_score))
+    return results
+
+
 def predict(model, x_global, x_local, x_ctx, box, temperature=.0):
+    x_images = [util.expand(x) for x in util.as_list(x_global) + util.as_list(x_local)]
+    candidates, likelihoods = get_decoder(model).decode(x_images, util.expand(x_ctx), temperature)
+    return candidates[0], likelihoods[0]
+
+
+def predict_beam(model, x_global, x_local, x_ctx, box, beam_width=4, length_penalty=.7):
+    x_images = [util.expand(x) for x in util.as_list(x_global) + util.as_list(x_local)]
+    candidates, scores = get_decoder(model).beam_search(x_images, util.expand(x_ctx), beam_width, length_penalty)
+    return candidates[0], scores[0]
+
+
+# The original decoding loop: every step re-runs the whole model, including
+# both ResNets, over the left-padded window of words so far.
+# Kept as the reference for Decoder (see test_decoder), and selectable with windowed
+def predict_windowed(model, x_global, x_local, x_ctx, box, temperature=.0):
     indices = util.left_pad([])
     #x0, x1, y0, y1 = box
     #coords = [0, (y0 + y1) / 2, (x0 + x1) / 2]
     likelihoods = []
     for i in range(MAX_WORDS):
-        preds = model.predict([util.expand(x_global), util.expand(x_local), util.expand(indices), util.expand(x_ctx)])
+        x_images = [util.expand(x) for x in util.as_list(x_global) + util.as_list(x_local)]
+        preds = model.predict(x_images + [util.expand(indices), util.expand(x_ctx)])
         preds = preds[0]
         indices = np.roll(indices, -1)
         if temperature > 0:
@@ -165,6 +571,298 @@ def predict(model, x_global, x_local, x_ctx, box, temperature=.0):
     return words.words(indices), np.mean(likelihoods)
 
 
+decoders = weakref.WeakKeyDictionary()
+
+# Set (eg. with --windowed in evaluate.py, server.py and train.py) to decode
+# with predict_windowed instead of Decoder
+windowed = False
+
+
+def get_decoder(model):
+    if model not in decoders:
+        decoders[model] = WindowedDecoder(model) if windowed else Decoder(model)
+    return decoders[model]
+
+
+class WindowedDecoder(object):
+    """
+    Decoder.decode with the original loop, one caption at a time.
+    It has no beam search.
+    """
+    def __init__(self, model):
+        self.model = model
+        # The models the caller should prepare for use from another thread
+        self.models = [model]
+
+    def decode(self, x_images, x_ctx, temperature=.0, rows_per_image=1):
+        n = len(x_ctx) * rows_per_image
+        temperatures = np.broadcast_to(np.asarray(temperature, dtype=float), (n,))
+        half = len(x_images) // 2
+        captions, likelihoods = [], []
+        for i in range(n):
+            image = i // rows_per_image
+            x_global = [x[image] for x in x_images[:half]]
+            x_local = [x[image] for x in x_images[half:]]
+            caption, likelihood = predict_windowed(self.model, x_global, x_local, x_ctx[image], None, temperatures[i])
+            captions.append(caption)
+            likelihoods.append(likelihood)
+        return captions, np.array(likelihoods)
+
+    def beam_search(self, x_images, x_ctx, beam_width=4, length_penalty=.7):
+        raise ValueError("Beam search needs Decoder, it can't be combined with windowed decoding")
+
+
+class Decoder(object):
+    """
+    Incremental decoding for a model from build_model (or build_feature_model).
+
+    The images and box context are encoded once. After that, each step only
+    runs the word-level layers for one token, carrying the state of both GRUs.
+    Both models here are built from the model's own layers, so they always
+    use its current weights.
+
+    The model reads words in a left-padded window of MAX_WORDS, so the window
+    that predicts word t is (MAX_WORDS - t) padding tokens followed by words
+    0..t-1. Each of those windows is kept as a row with its own GRU state:
+    the padding prefix is run once, then every new word advances all rows
+    that still have words to read, in a single batched step. Predictions are
+    therefore the same as re-running the model over each window.
+    """
+    def __init__(self, model):
+        l = get_layers(model)
+        # The ResNet, or the learnable head of a feature model
+        image_model = [layer for layer in model.layers if isinstance(layer, models.Model)][0]
+        image_shapes = [K.int_shape(t)[1:] for t in image_model.inputs]
+        gru_size = l['caption_gru'].units
+        self.gru_size = gru_size
+
+        # Encoder: images and box context -> per-caption feature vectors
+        inputs_global = [layers.Input(shape=shape) for shape in image_shapes]
+        inputs_local = [layers.Input(shape=shape) for shape in image_shapes]
+        input_ctx = layers.Input(shape=(5,))
+        unwrap = lambda inputs: inputs[0] if len(inputs) == 1 else inputs
+        image_global = l['image_global_bn'](image_model(unwrap(inputs_global)))
+        image_global = l['image_global_dense_bn'](l['image_global_dense'](image_global))
+        image_local = l['image_local_bn'](image_model(unwrap(inputs_local)))
+        image_local = l['image_local_dense_bn'](l['image_local_dense'](image_local))
+        ctx = l['ctx_bn'](input_ctx)
+        self.encoder = models.Model(inputs=inputs_global + inputs_local + [input_ctx],
+                outputs=[image_global, image_local, ctx])
+
+        # Step: one word and the previous GRU states -> new GRU states and word probabilities
+        embedding = l['word_embedding']
+        wordvec_size = K.int_shape(embedding.embeddings)[1]
+        input_word = layers.Input(shape=(1,), dtype='int32')
+        input_global = layers.Input(shape=K.int_shape(image_global)[1:])
+        input_local = layers.Input(shape=K.int_shape(image_local)[1:])
+        input_step_ctx = layers.Input(shape=(5,))
+        input_h1 = layers.Input(shape=(gru_size,))
+        input_h2 = layers.Input(shape=(gru_size,))
+        # The Embedding and TimeDistributed layers are tied to MAX_WORDS steps,
+        # so apply their weights to a single step directly
+        language = layers.Lambda(lambda w: K.gather(embedding.embeddings, K.cast(w, 'int32')),
+                output_shape=(1, wordvec_size))(input_word)
+        language = l['word_bn'](language)
+        h1 = l['language_gru'](language, initial_state=input_h1)
+        language = l['language_gru_bn'](h1)
+        language = l['language_dense'].layer(language)
+        language = l['language_dense_bn'](language)
+        x = layers.concatenate([
+            layers.RepeatVector(1)(input_global),
+            layers.RepeatVector(1)(input_local),
+            layers.RepeatVector(1)(input_step_ctx),
+            language])
+        h2 = l['caption_gru'](x, initial_state=input_h2)
+        probs = l['caption_softmax'](l['caption_gru_bn'](h2))
+        h1 = layers.Reshape((gru_size,))(h1)
+        self.step = models.Model(
+                inputs=[input_word, input_global, input_local, input_step_ctx, input_h1, input_h2],
+                outputs=[h1, h2, probs])
+        # The models the caller should prepare for use from another thread
+        self.models = [self.encoder, self.step]
+
+    def encode(self, x_images, x_ctx):
+        return self.encoder.predict(x_images + [x_ctx], batch_size=len(x_ctx))
+
+    def advance(self, tokens, context, h1, h2):
+        # tokens, h1 and h2 have one row per window; context is repeated to match
+        repeat = len(tokens) // len(context[0])
+        context = [np.repeat(c, repeat, axis=0) for c in context]
+        return self.step.predict([tokens.reshape(-1, 1)] + context + [h1, h2], batch_size=len(tokens))
+
+    def start(self, context):
+        """
+        Runs the padding that begins every window.
+        Returns the states H1, H2, where H[:, t] is the state of the window
+        that predicts word t, and the predictions for word 0.
+        """
+        n = len(context[0])
+        H1 = np.zeros((n, MAX_WORDS, self.gru_size), dtype=util.FLOAT_DTYPE)
+        H2 = np.zeros((n, MAX_WORDS, self.gru_size), dtype=util.FLOAT_DTYPE)
+        h1 = np.zeros((n, self.gru_size), dtype=util.FLOAT_DTYPE)
+        h2 = np.zeros((n, self.gru_size), dtype=util.FLOAT_DTYPE)
+        padding = np.zeros(n, dtype=util.INDEX_DTYPE)
+        for k in range(1, MAX_WORDS + 1):
+            h1, h2, probs = self.advance(padding, context, h1, h2)
+            H1[:, MAX_WORDS - k] = h1
+            H2[:, MAX_WORDS - k] = h2
+        # The window for word 0 is all padding
+        return H1, H2, probs
+
+    def decode(self, x_images, x_ctx, temperature=.0, rows_per_image=1):
+        """
+        x_images: the batched image inputs, global then local
+        temperature: a number, or one per caption. 0 is greedy decoding
+        rows_per_image: decode this many captions of each image, which
+            share its encoding and padding, eg. at different temperatures
+        Returns (captions, mean likelihoods), like predict for each caption
+        """
+        context = self.encode(x_images, x_ctx)
+        H1, H2, probs = self.start(context)
+        if rows_per_image > 1:
+            context = [np.repeat(c, rows_per_image, axis=0) for c in context]
+            H1, H2, probs = [np.repeat(a, rows_per_image, axis=0) for a in (H1, H2, probs)]
+        n = len(x_ctx) * rows_per_image
+        temperatures = np.broadcast_to(np.asarray(temperature, dtype=float), (n,))
+        tokens = np.zeros((n, MAX_WORDS), dtype=util.INDEX_DTYPE)
+        likelihoods = np.zeros((n, MAX_WORDS))
+        for t in range(MAX_WORDS):
+            for i in range(n):
+                if temperatures[i] > 0:
+                    tokens[i, t] = sample(probs[i], temperatures[i])
+                else:
+                    tokens[i, t] = np.argmax(probs[i], axis=-1)
+                likelihoods[i, t] = probs[i, tokens[i, t]]
+            if t == MAX_WORDS - 1:
+                break
+            # Feed word t to the windows for words t+1 onwards
+            rows = MAX_WORDS - 1 - t
+            step_tokens = np.repeat(tokens[:, t], rows)
+            h1, h2, probs = self.advance(step_tokens, context,
+                    H1[:, t+1:].reshape(-1, self.gru_size), H2[:, t+1:].reshape(-1, self.gru_size))
+            H1[:, t+1:] = h1.reshape(n, rows, self.gru_size)
+            H2[:, t+1:] = h2.reshape(n, rows, self.gru_size)
+            # The window for word t+1 is now complete
+            probs = probs.reshape(n, rows, -1)[:, 0]
+        return words.vocabulary.decode_batch(tokens), likelihoods.mean(axis=1)
+
+    def beam_search(self, x_images, x_ctx, beam_width=4, length_penalty=.7):
+        """
+        Beam search over all images at once: every step expands all beams of
+        all images in one batched forward pass.
+        Hypotheses are ranked by total log probability / length ** length_penalty
+        and stop growing at words.END_TOKEN_IDX. The search ends early once
+        every beam has stopped.
+        Returns (captions, scores) of the best hypothesis for each image
+        """
+        context = self.encode(x_images, x_ctx)
+        n, B, size = len(x_ctx), beam_width, self.gru_size
+        H1, H2, probs = self.start(context)
+        # From here on, each image has B rows of state, beams of one image are adjacent
+        context = [np.repeat(c, B, axis=0) for c in context]
+        H1 = np.repeat(H1, B, axis=0).reshape(n, B, MAX_WORDS, size)
+        H2 = np.repeat(H2, B, axis=0).reshape(n, B, MAX_WORDS, size)
+        probs = np.repeat(probs, B, axis=0)
+
+        tokens = np.zeros((n, B, MAX_WORDS), dtype=util.INDEX_DTYPE)
+        lengths = np.zeros((n, B))
+        finished = np.zeros((n, B), dtype=bool)
+        # Beams start out identical, so only expand the first one
+        log_probs = np.full((n, B), -np.inf)
+        log_probs[:, 0] = 0
+        images = np.arange(n)[:, None]
+        for t in range(MAX_WORDS):
+            vocabulary_size = probs.shape[-1]
+            expanded = log_probs[:, :, None] + np.log(np.maximum(probs.reshape(n, B, -1), 1e-20))
+            # A finished beam carries over unchanged, as itself followed by the END token
+            expanded[finished] = -np.inf
+            expanded[finished, words.END_TOKEN_IDX] = log_probs[finished]
+            expanded_lengths = lengths + ~finished
+            scores = expanded / (expanded_lengths ** length_penalty)[:, :, None]
+
+            best = np.argsort(-scores.reshape(n, -1), axis=1, kind='mergesort')[:, :B]
+            parents, next_tokens = best // vocabulary_size, best % vocabulary_size
+            log_probs = expanded.reshape(n, -1)[images, best]
+            lengths = expanded_lengths[images, parents]
+            finished = finished[images, parents] | (next_tokens == words.END_TOKEN_IDX)
+            tokens = tokens[images, parents]
+            tokens[:, :, t] = next_tokens
+            H1, H2 = H1[images, parents], H2[images, parents]
+            if t == MAX_WORDS - 1 or finished.all():
+                break
+
+            rows = MAX_WORDS - 1 - t
+            step_tokens = np.repeat(next_tokens.reshape(-1), rows)
+            h1, h2, probs = self.advance(step_tokens, context,
+                    H1[:, :, t+1:].reshape(-1, size), H2[:, :, t+1:].reshape(-1, size))
+            H1[:, :, t+1:] = h1.reshape(n, B, rows, size)
+            H2[:, :, t+1:] = h2.reshape(n, B, rows, size)
+            probs = probs.reshape(n * B, rows, -1)[:, 0]
+
+        scores = log_probs / lengths ** length_penalty
+        best = np.argmax(scores, axis=1)
+        return words.vocabulary.decode_batch(tokens[images[:, 0], best]), scores[images[:, 0], best]
+
+
+def randomize_layers(model, scale=.3, seed=0):
+    # Untrained, every caption is one word repeated. Larger random weights
+    # make each word depend on the image and the words before it
+    rng = np.random.RandomState(seed)
+    names = ['image_global_dense', 'image_local_dense', 'word_embedding', 'language_gru',
+            'language_dense', 'caption_gru', 'caption_softmax']
+    for name, layer in get_layers(model).items():
+        if name in names:
+            layer.set_weights([rng.normal(scale=scale, size=w.shape).astype(w.dtype) for w in layer.get_weights()])
+
+
+def test_decoder(model):
+    # Greedy decoding must give the same captions as the original loop,
+    # one image at a time and in a batch
+    decoder = Decoder(model)
+    examples, expected = [], []
+    for f in ['cat.jpg', 'dog.jpg', 'horse.jpg', 'car.jpg']:
+        x_global = util.decode_jpg(f)
+        height, width, _ = x_global.shape
+        box = (width * .25, width * .75, height * .25, height * .75)
+        x_local = util.decode_jpg(f, crop_to_box=box)
+        x_ctx = img_ctx(box)
+        examples.append((x_global, x_local, x_ctx))
+        expected.append(predict_windowed(model, x_global, x_local, x_ctx, box))
+        candidates, likelihoods = decoder.decode([util.expand(x_global), util.expand(x_local)], util.expand(x_ctx))
+        assert candidates[0] == expected[-1][0], (f, candidates[0], expected[-1][0])
+        assert np.isclose(likelihoods[0], expected[-1][1], rtol=1e-3), (f, likelihoods[0], expected[-1][1])
+    x_images = [np.stack([e[0] for e in examples]), np.stack([e[1] for e in examples])]
+    candidates, likelihoods = decoder.decode(x_images, np.stack([e[2] for e in examples]))
+    assert list(candidates) == [c for c, _ in expected], (candidates, expected)
+    assert np.allclose(likelihoods, [l for _, l in expected], rtol=1e-3), (likelihoods, expected)
+    print("Decoder tests complete!")
+
+
+def test_evaluate_batch(model, beam_width=4):
+    # evaluate.py's batched mode must score the greedy and beam search captions
+    # like its --sequential mode. Sampled captions depend on the order of
+    # random draws, so they are only checked for count
+    examples = []
+    for f in ['cat.jpg', 'dog.jpg', 'horse.jpg', 'car.jpg']:
+        x_global = util.decode_jpg(f)
+        height, width, _ = x_global.shape
+        box = (width * .25, width * .75, height * .25, height * .75)
+        x_local = util.decode_jpg(f, crop_to_box=box)
+        texts = dataset_grefexp.Refexps(['the {} in the middle'.format(f[:-4]), 'a {}'.format(f[:-4])])
+        examples.append((x_global, x_local, img_ctx(box), box, texts))
+    batched = [score_all(results, e[4]) for e, results in zip(examples, evaluate_batch(model, examples, beam_width=beam_width))]
+    for e, scores in zip(examples, batched):
+        assert len(scores) == len(SAMPLE_TEMPERATURES) + 1
+        expected = [evaluate(model, *e, temperature=0), evaluate(model, *e, beam_width=beam_width)]
+        for score, expected_score in zip([scores[0], scores[-1]], expected):
+            assert score['candidate'] == expected_score['candidate'], (score, expected_score)
+            for metric in ['bleu1', 'bleu2', 'rouge']:
+                assert np.isclose(score[metric], expected_score[metric], rtol=1e-3), (metric, score, expected_score)
+            # oneDNN rounds differently at different batch sizes, and a beam score sums the log of every word
+            assert np.isclose(score['likelihood'], expected_score['likelihood'], rtol=1e-2), (score, expected_score)
+    print("Batched evaluation tests complete!")
+
+
 def sample(preds, temperature=1.0):
     # helper function to sample an index from a probability array
     preds = np.asarray(preds).astype('float64')
@@ -176,10 +874,23 @@ def sample(preds, temperature=1.0):
 
 
 def bleu(candidate, references):
+    # One candidate at a time is faster with the plain scorer, see score_all for batches
     scores, _ = bleu_scorer.BleuScorer(candidate, references, n=2).compute_score(option='closest')
     return scores
 
 
+# Consecutive score_all calls usually score candidates for the same annotation
+cooked_references = {}
+
+
+def cook_references(references):
+    key = tuple(references)
+    if key not in cooked_references:
+        cooked_references.clear()
+        cooked_references[key] = bleu_scorer.CookedRefs(references, n=2)
+    return cooked_references[key]
+
+
 def rouge(candidate, references):
     return rouge_scorer.Rouge().calc_score([candidate], references)
 
@@ -191,5 +902,23 @@ def demo(model):
         box = (width * .25, width * .75, height * .25, height * .75)
         x_local = util.decode_jpg(f, crop_to_box=box)
         x_ctx = img_ctx(box)
-        print("Prediction for {} {}:".format(f, box)),
+        print("Prediction for {} {}:".format(f, box), end=' ')
         print(predict(model, x_global, x_local, x_ctx, box))
+
+
+if __name__ == '__main__':
+    # python caption.py --test-decoder|--test-evaluate [model.h5], with the
+    # weights in model.h5 if given, or else random ones (see randomize_layers)
+    args, options = datastore.parse_options(sys.argv[1:])
+    if 'test-decoder' in options or 'test-evaluate' in options:
+        model = build_model()
+        if args:
+            model.load_weights(args[0])
+        else:
+            randomize_layers(model)
+        if 'test-decoder' in options:
+            test_decoder(model)
+        if 'test-evaluate' in options:
+            test_evaluate_batch(model)
+    else:
+        print("Usage: {} --test-decoder|--test-evaluate [model.h5]".format(sys.argv[0]))
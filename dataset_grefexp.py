@@ -1,43 +1,318 @@
 import os
 import sys
 import json
+import base64
 import random
+import itertools
 
-import redis
 import numpy as np
 
-DATA_DIR = '/home/nealla/data'
+import datastore
+import shards
+import util
+import words
 
 KEY_GREFEXP_TRAIN = 'dataset_grefexp_train'
 KEY_GREFEXP_VAL = 'dataset_grefexp_val'
 
-conn = redis.Redis()
-categories = {v['id']: v['name'] for v in json.load(open('coco_categories.json'))}
+# Follows grefexp -> coco anno -> coco img on the server and returns only
+# the fields we need, so a training sample costs one round trip.
+# KEYS are the grefexp and coco anno keys (see join_keys). The coco img key
+# depends on the anno's image_id, so the script has to build it: fine on a
+# standalone Redis, but not allowed on Redis Cluster, which is not supported
+JOIN_SCRIPT = """
+local grefexp = cjson.decode(redis.call('GET', KEYS[1]))
+local anno = cjson.decode(redis.call('GET', KEYS[2]))
+local img_key = 'coco2014_img_' .. string.format('%d', anno['image_id'])
+local img = cjson.decode(redis.call('GET', img_key))
+local texts = {}
+for i, refexp in ipairs(grefexp['refexps']) do
+    texts[i] = refexp['raw']
+end
+return cjson.encode({
+    filename=img['filename'],
+    bbox=anno['bbox'],
+    texts=texts,
+    stripped=grefexp['stripped'],
+    token_ids=grefexp['token_ids'],
+    category_id=anno['category_id'],
+})
+"""
+
+# Nothing is connected or read at import time, see datastore.get_conn and get_categories
+join_script = None
+categories = None
+
+
+def get_join_script():
+    # Registered again with each new connection, eg. in a forked worker
+    global join_script
+    conn = datastore.get_conn()
+    if join_script is None or join_script.registered_client is not conn:
+        join_script = conn.register_script(JOIN_SCRIPT)
+    return join_script
+
+
+def get_categories():
+    global categories
+    if categories is None:
+        with open('coco_categories.json') as fp:
+            categories = {v['id']: v['name'] for v in json.load(fp)}
+    return categories
+
+
+def reconnect():
+    # Worker processes must not share the parent's sockets. datastore also
+    # checks for this, but a worker may as well start with its own pool
+    datastore.reset()
+
+
+class SampleIndex(object):
+    """
+    In-process copy of the annotation ids in a reference key, loaded once
+    so that sampling is an array lookup instead of a Redis round trip.
+
+    ids are sorted, so positions (and therefore seeded epochs and parts)
+    don't depend on the order Redis returns set members in.
+    """
+    def __init__(self, ids, seed=None):
+        self.ids = np.sort(np.asarray(ids, dtype=np.int64))
+        self.seed = seed
+        # Unseeded indices share the global RNG, so reseeding np.random in a worker reseeds them too
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
+
+    @classmethod
+    def load(cls, reference_key, seed=None):
+        ids = [int(key.split('_')[-1]) for key in datastore.get_conn().smembers(reference_key)]
+        return cls(ids, seed=seed)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def key(self, position):
+        return 'grefexp_{}'.format(self.ids[position])
+
+    def sample(self, count):
+        # Uniform sampling with replacement, like SRANDMEMBER
+        positions = self.rng.randint(0, len(self.ids), size=count)
+        return [self.key(p) for p in positions]
+
+    def part(self, part=0, parts=1):
+        # part of parts disjoint, contiguous ranges of ids, like shards.ShardReader.epoch
+        bounds = np.linspace(0, len(self.ids), parts + 1).astype(np.int64)
+        seed = None if self.seed is None else self.seed + part
+        return SampleIndex(self.ids[bounds[part]:bounds[part + 1]], seed=seed)
+
+    def epoch(self, epoch=0):
+        # Every key exactly once, in an order fixed by (seed, epoch)
+        rng = self.rng if self.seed is None else np.random.RandomState([self.seed, epoch])
+        for position in rng.permutation(len(self.ids)):
+            yield self.key(position)
+
+    def epochs(self):
+        epoch = 0
+        while True:
+            for key in self.epoch(epoch):
+                yield key
+            epoch += 1
+
+
+sample_indices = {}
+shard_readers = {}
+example_streams = {}
+
+# Annotations read from shards are mixed this many at a time, see shuffled
+SHUFFLE_BUFFER = 1024
+
+
+def shard_dir():
+    # If set, packed shards are read from <shard_dir>/<reference_key>/ instead of Redis (see shards.py)
+    return datastore.settings['shard-dir']
+
+
+def get_index(reference_key=KEY_GREFEXP_TRAIN):
+    if reference_key not in sample_indices:
+        if shard_dir() is not None:
+            sample_indices[reference_key] = SampleIndex(get_shard_reader(reference_key).annotation_ids)
+        else:
+            sample_indices[reference_key] = SampleIndex.load(reference_key)
+    return sample_indices[reference_key]
+
+
+def get_shard_reader(reference_key):
+    if reference_key not in shard_readers:
+        shard_readers[reference_key] = shards.ShardReader(os.path.join(shard_dir(), reference_key))
+    return shard_readers[reference_key]
+
+
+def get_shard_annotation(key):
+    # Only the splits that have been packed are searched
+    annotation_id = int(key.split('_')[-1])
+    for reference_key in [KEY_GREFEXP_TRAIN, KEY_GREFEXP_VAL]:
+        if not shards.exists(os.path.join(shard_dir(), reference_key)):
+            continue
+        reader = get_shard_reader(reference_key)
+        if annotation_id in reader:
+            return reader.get_annotation(annotation_id)
+    raise KeyError(key)
 
 
 def example(reference_key=KEY_GREFEXP_TRAIN):
-    key = conn.srandmember(reference_key)
+    key = get_index(reference_key).sample(1)[0]
     return get_annotation_for_key(key)
 
 
-def get_all_keys(reference_key=KEY_GREFEXP_VAL, shuffle=True):
-    keys = list(conn.smembers(reference_key))
+def examples(count, reference_key=KEY_GREFEXP_TRAIN):
+    keys = get_index(reference_key).sample(count)
+    return get_annotations_for_keys(keys)
+
+
+def sequential_examples(count, reference_key=KEY_GREFEXP_TRAIN, part=0, parts=1):
+    """
+    Like examples, but without replacement: each epoch visits every
+    annotation in part of parts once, so worker processes never overlap.
+    From packed shards the annotations are read in the order they are
+    stored (see shards.ShardReader.epoch), through a shuffle buffer so that
+    batches differ from epoch to epoch. From Redis, each epoch is a
+    shuffle of the part's keys (see SampleIndex.part).
+    """
+    stream = (reference_key, part, parts)
+    if stream not in example_streams:
+        if shard_dir() is not None:
+            example_streams[stream] = shuffled(get_shard_reader(reference_key).annotations(part=part, parts=parts))
+        else:
+            example_streams[stream] = get_index(reference_key).part(part, parts).epochs()
+    items = list(itertools.islice(example_streams[stream], count))
+    return items if shard_dir() is not None else get_annotations_for_keys(items)
+
+
+def shuffled(items, size=SHUFFLE_BUFFER):
+    # items in a random order, holding at most size of them at a time
+    buffer = []
+    for item in items:
+        if len(buffer) < size:
+            buffer.append(item)
+            continue
+        i = np.random.randint(size)
+        yield buffer[i]
+        buffer[i] = item
+    np.random.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
+def get_all_keys(reference_key=KEY_GREFEXP_VAL, shuffle=True, seed=0):
+    # The shuffled order is the same on every call, so runs over a prefix or a shard can be resumed
+    index = get_index(reference_key)
+    keys = [index.key(i) for i in range(len(index))]
     if shuffle:
-        random.shuffle(keys)
+        random.Random(seed).shuffle(keys)
     return keys
 
 
+def join_keys(key):
+    # grefexp_<annotation id> and the coco anno it refers to
+    return [key, 'coco2014_anno_{}'.format(key.split('_')[-1])]
+
+
 def get_annotation_for_key(key):
-    grefexp = json.loads(conn.get(key))
-    anno_key = 'coco2014_anno_{}'.format(grefexp['annotation_id'])
-    anno = json.loads(conn.get(anno_key))
-    img_key = 'coco2014_img_{}'.format(anno['image_id'])
-    img_meta = json.loads(conn.get(img_key))
-
-    jpg_data = open(os.path.join(DATA_DIR, img_meta['filename'])).read()
-
-    x0, y0, width, height = anno['bbox']
-    box = (x0, x0 + width, y0, y0 + height)
-    texts = [g['raw'] for g in grefexp['refexps']]
-    category = categories[anno['category_id']]
+    if shard_dir() is not None:
+        return get_shard_annotation(key)
+    record = json.loads(get_join_script()(keys=join_keys(key)))
+    return unpack_record(record)
+
+
+def get_annotations_for_keys(keys):
+    if shard_dir() is not None:
+        return [get_shard_annotation(key) for key in keys]
+    return [unpack_record(record) for record in get_joined_records(keys)]
+
+
+def get_joined_records(keys):
+    # Resolve many keys with pipelined round trips
+    script = get_join_script()
+    records = datastore.pipelined(keys, lambda pipe, key: script(keys=join_keys(key), client=pipe))
+    return [json.loads(record) for record in records]
+
+
+class Refexps(list):
+    """
+    The raw refexps of an annotation, as a list of str, which also carries
+        stripped: util.strip of each refexp
+        tokens: words.indices of each stripped refexp, as int32 arrays
+    Both are precomputed by load_grefexp_to_redis.py, and only computed
+    here (once) for records loaded without them.
+    """
+    def __init__(self, texts, stripped=None, tokens=None):
+        list.__init__(self, texts)
+        self._stripped = stripped
+        self._tokens = tokens
+
+    @property
+    def stripped(self):
+        if self._stripped is None:
+            self._stripped = [util.strip(text) for text in self]
+        return self._stripped
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = words.vocabulary.encode_batch(self.stripped)
+        return self._tokens
+
+
+def refexps(texts):
+    # texts as Refexps, eg. for the plain lists in an ArrayStore
+    return texts if isinstance(texts, Refexps) else Refexps(texts)
+
+
+def encode_token_ids(stripped):
+    # Token ids of the stripped refexps, packed (see words.pack) and base64 encoded to fit in JSON
+    return base64.b64encode(words.pack(words.vocabulary.encode_batch(stripped))).decode('ascii')
+
+
+def decode_token_ids(token_ids):
+    return words.unpack(base64.b64decode(token_ids))
+
+
+def bbox_to_box(bbox):
+    x0, y0, width, height = bbox
+    return (x0, x0 + width, y0, y0 + height)
+
+
+def unpack_record(record):
+    with open(datastore.data_path(record['filename']), 'rb') as fp:
+        jpg_data = fp.read()
+
+    box = bbox_to_box(record['bbox'])
+    token_ids = record.get('token_ids')
+    texts = Refexps(record['texts'], record.get('stripped'), decode_token_ids(token_ids) if token_ids else None)
+    category = get_categories()[record['category_id']]
     return jpg_data, box, texts
+
+
+def test_sample_index():
+    ids = [9, 3, 7, 1, 5, 8, 2]
+    index = SampleIndex(ids, seed=4)
+    assert list(index.ids) == sorted(ids)
+    # Seeded epochs don't depend on the order ids are given in, and differ from epoch to epoch
+    assert list(index.epoch(2)) == list(SampleIndex(sorted(ids), seed=4).epoch(2))
+    assert list(index.epoch(0)) != list(index.epoch(1))
+    assert sorted(index.epoch(1)) == sorted(index.key(p) for p in range(len(ids)))
+    assert list(itertools.islice(index.epochs(), 2 * len(ids))) == list(index.epoch(0)) + list(index.epoch(1))
+
+    # Parts are disjoint and cover every id
+    parts = [index.part(part, 3) for part in range(3)]
+    keys = [set(part.epoch(0)) for part in parts]
+    assert sum(len(k) for k in keys) == len(ids) and set.union(*keys) == set(index.epoch(0))
+    assert list(parts[1].epoch(3)) == list(SampleIndex(ids, seed=4).part(1, 3).epoch(3))
+
+    # A shuffle buffer reorders, but never drops or repeats
+    assert sorted(shuffled(range(100), size=10)) == list(range(100))
+    assert list(shuffled(range(100), size=10)) != list(range(100))
+    assert sorted(shuffled(range(5), size=10)) == list(range(5))
+    print("Sample index tests complete!")
+
+
+if __name__ == '__main__':
+    test_sample_index()
@@ -0,0 +1,197 @@
+"""
+Shared Redis connections and data locations.
+
+Each process has a single connection pool, which is created on first use
+and holds at most pool-size connections. A caller that finds every
+connection in use waits up to the Redis timeout for one to be returned,
+instead of opening another. A pool belongs to the process that created
+it. After a fork, get_conn sees a new pid and builds a fresh pool, so
+worker processes never share the parent's sockets.
+
+Settings are read from the environment. The entry points also accept
+them as --name=value options (see parse_options), which take precedence
+(see configure):
+
+    option              environment          default
+    --data-dir          GREFEXP_DATA_DIR     /home/nealla/data
+    --shard-dir         GREFEXP_SHARD_DIR    packed shards (see shards.py), read instead of Redis
+    --redis-host        REDIS_HOST           localhost
+    --redis-port        REDIS_PORT           6379
+    --redis-db          REDIS_DB             0
+    --redis-socket      REDIS_SOCKET         Unix socket path, used instead of host and port
+    --redis-pool-size   REDIS_POOL_SIZE      8
+    --redis-timeout     REDIS_TIMEOUT        30 seconds to connect, run a command or wait for the pool
+    --redis-pipeline    REDIS_PIPELINE       1000 commands per pipelined round trip
+"""
+import os
+import itertools
+
+SETTINGS = [
+    # option, environment variable, default, type
+    ('data-dir', 'GREFEXP_DATA_DIR', '/home/nealla/data', str),
+    ('shard-dir', 'GREFEXP_SHARD_DIR', None, str),
+    ('redis-host', 'REDIS_HOST', 'localhost', str),
+    ('redis-port', 'REDIS_PORT', 6379, int),
+    ('redis-db', 'REDIS_DB', 0, int),
+    ('redis-socket', 'REDIS_SOCKET', None, str),
+    ('redis-pool-size', 'REDIS_POOL_SIZE', 8, int),
+    ('redis-timeout', 'REDIS_TIMEOUT', 30, float),
+    ('redis-pipeline', 'REDIS_PIPELINE', 1000, int),
+]
+
+
+def read_settings(environ=os.environ):
+    settings = {}
+    for option, variable, default, kind in SETTINGS:
+        value = environ.get(variable)
+        settings[option] = kind(value) if value else default
+    return settings
+
+
+settings = read_settings()
+
+# Created on first use, and again in every forked process
+pool = None
+conn = None
+pid = None
+
+
+def parse_options(argv):
+    """
+    Splits the arguments of an entry point into positional args and a dict
+    of options, which are given as --name=value anywhere on the command line.
+    A bare --name has the value ''
+    """
+    args = [arg for arg in argv if not arg.startswith('--')]
+    options = dict(arg[2:].partition('=')[::2] for arg in argv if arg.startswith('--'))
+    return args, options
+
+
+def configure(options):
+    """
+    Applies any settings among options, the --name=value options of an entry point
+    An empty value (--redis-socket=) restores the default
+    """
+    for option, variable, default, kind in SETTINGS:
+        if option in options:
+            settings[option] = kind(options[option]) if options[option] else default
+    reset()
+
+
+def reset():
+    # Connections are opened again on next use, with the current settings
+    global pool, conn, pid
+    pool, conn, pid = None, None, None
+
+
+def get_pool():
+    global pool, pid
+    if pool is None or pid != os.getpid():
+        # redis is only imported by processes that use it
+        import redis
+        kwargs = {
+            'db': settings['redis-db'],
+            'max_connections': settings['redis-pool-size'],
+            'timeout': settings['redis-timeout'],
+            'socket_timeout': settings['redis-timeout'],
+            'socket_connect_timeout': settings['redis-timeout'],
+            'decode_responses': True,
+        }
+        if settings['redis-socket']:
+            kwargs['connection_class'] = redis.UnixDomainSocketConnection
+            kwargs['path'] = settings['redis-socket']
+        else:
+            kwargs['host'] = settings['redis-host']
+            kwargs['port'] = settings['redis-port']
+        pool = redis.BlockingConnectionPool(**kwargs)
+        pid = os.getpid()
+    return pool
+
+
+def get_conn():
+    global conn
+    pool = get_pool()
+    if conn is None or conn.connection_pool is not pool:
+        import redis
+        conn = redis.Redis(connection_pool=pool)
+    return conn
+
+
+def pipelined(items, add, size=None, conn=None):
+    """
+    Calls add(pipe, item) for each of items, which may be a generator, on
+    non-transactional pipelines of size items each
+    Returns the results of every command, in order
+    """
+    conn = conn or get_conn()
+    size = size or settings['redis-pipeline']
+    items = iter(items)
+    results = []
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return results
+        pipe = conn.pipeline(transaction=False)
+        for item in chunk:
+            add(pipe, item)
+        results.extend(pipe.execute())
+
+
+def data_path(filename):
+    return os.path.join(settings['data-dir'], filename)
+
+
+def test_datastore():
+    import redis
+    saved = dict(settings)
+    try:
+        assert read_settings({})['data-dir'] == '/home/nealla/data'
+        environ = {'REDIS_PORT': '6380', 'REDIS_TIMEOUT': '2.5', 'GREFEXP_DATA_DIR': '/data'}
+        assert read_settings(environ)['redis-port'] == 6380
+        assert read_settings(environ)['redis-timeout'] == 2.5
+        assert read_settings(environ)['data-dir'] == '/data'
+
+        args, options = parse_options(['caption', '--redis-socket=/tmp/redis.sock', 'model.h5', '--redis-pool-size=3', '--xla'])
+        assert args == ['caption', 'model.h5'] and options['xla'] == ''
+        configure(dict(options, **{'batch-size': '32'}))
+        assert get_pool() is get_pool() and get_conn() is get_conn()
+        assert get_pool().connection_class is redis.UnixDomainSocketConnection
+        assert get_pool().max_connections == 3
+        assert get_conn().connection_pool is get_pool()
+
+        # A forked process builds its own pool
+        parent_pool = get_pool()
+        child = os.fork()
+        if child == 0:
+            os._exit(0 if get_pool() is not parent_pool and get_conn().connection_pool is get_pool() else 1)
+        assert os.waitpid(child, 0)[1] == 0
+        assert get_pool() is parent_pool
+
+        configure({'redis-host': 'example', 'redis-socket': ''})
+        assert get_pool() is not parent_pool
+        assert get_pool().connection_kwargs['host'] == 'example'
+        assert data_path('coco/x.jpg') == os.path.join(settings['data-dir'], 'coco/x.jpg')
+
+        # Results come back in order, from one round trip per chunk
+        class Pipeline(list):
+            def execute(self):
+                round_trips.append(len(self))
+                return [-x for x in self]
+
+        class Connection(object):
+            def pipeline(self, transaction=True):
+                assert not transaction
+                return Pipeline()
+
+        round_trips = []
+        results = pipelined((i for i in range(7)), lambda pipe, i: pipe.extend([i, i]), size=3, conn=Connection())
+        assert results == [-i for i in range(7) for _ in range(2)]
+        assert round_trips == [6, 6, 2]
+    finally:
+        settings.update(saved)
+        reset()
+    print("Datastore tests complete!")
+
+
+if __name__ == '__main__':
+    test_datastore()
@@ -1,53 +1,193 @@
+"""
+Usage:
+    python evaluate.py caption model.h5 [--shard=i/N] [--results=file.jsonl] [--beam=N]
+        [--features=store | --crops=store] [--batch-size=32] [--workers=N] [--sequential] [--windowed]
+        [--redis-host=... --data-dir=... (see datastore.py)]
+    python evaluate.py --merge results-0.jsonl results-1.jsonl ...
+
+Every evaluated annotation is appended to the results file as one JSON line,
+keyed by annotation id. Annotations already in the results file are skipped,
+so an interrupted run picks up where it left off. --shard=i/N evaluates every
+Nth annotation starting from the ith, so N runs (eg. on different machines)
+cover the val set between them. --merge aggregates any number of results files.
+"""
 import os
 import sys
+import json
 import time
 import importlib
+import itertools
+import collections
+import multiprocessing
 import numpy as np
 from pprint import pprint
 
-module_name = sys.argv[1]
+import datastore
+
+
+BATCH_SIZE = 32
+
+args, options = datastore.parse_options(sys.argv[1:])
+
+
+def read_results(filenames):
+    # The last line of a file may be cut short by a crash, it is evaluated again
+    results = {}
+    for filename in filenames:
+        if not os.path.exists(filename):
+            continue
+        for line in open(filename):
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            results[result['annotation_id']] = result
+    return results
+
+
+def report(results):
+    print("Number of Captions: {}".format(len(results)))
+    for kind in ['normal', 'sampled', 'beam']:
+        scores = [r[kind] for r in results.values() if r.get(kind)]
+        if not scores:
+            continue
+        for metric in ['bleu1', 'bleu2', 'rouge']:
+            data = np.array([s[metric] for s in scores])
+            print('{} {} min/max/mean'.format(kind, metric.upper()))
+            print("{} {} {}".format(data.min(), data.max(), data.mean()))
+
+
+if options.get('merge') is not None:
+    report(read_results(args))
+    exit()
+
+
+datastore.configure(options)
+module_name = args[0]
 module_name = module_name.rstrip('.py')
 target = importlib.import_module(module_name)
 
+# Scoring workers, only for the batched mode, started before the model is built so they fork without it
+pool = None
+if options.get('sequential') is None:
+    pool = multiprocessing.Pool(int(options.get('workers') or multiprocessing.cpu_count()))
+
 model_filename = '{}.{}.h5'.format(module_name, int(time.time()))
-if len(sys.argv) > 2:
-    model_filename = sys.argv[2]
+if len(args) > 1:
+    model_filename = args[1]
 
+# --windowed decodes with the original loop, see caption.windowed
+target.windowed = 'windowed' in options
 model = target.build_model()
 if os.path.exists(model_filename):
     model.load_weights(model_filename)
 
+shard, shards = 0, 1
+if options.get('shard'):
+    shard, shards = [int(n) for n in options['shard'].split('/')]
+    assert 0 <= shard < shards, "--shard=i/N needs 0 <= i < N"
+
+results_filename = options.get('results') or '{}.results.jsonl'.format(model_filename)
+if shards > 1 and not options.get('results'):
+    results_filename = '{}.results.{}-of-{}.jsonl'.format(model_filename, shard, shards)
+done = set(read_results([results_filename]))
+if done:
+    print("Skipping {} annotations already in {}".format(len(done), results_filename))
+results_file = open(results_filename, 'a')
+# Start on a new line after a line cut short by a crash
+if os.path.getsize(results_filename) > 0:
+    with open(results_filename, 'rb') as fp:
+        fp.seek(-1, os.SEEK_END)
+        if fp.read(1) != b'\n':
+            results_file.write('\n')
 
-g = target.validation_generator()
+if options.get('features'):
+    # Precomputed ResNet activations from preprocess.py, for the model variant that takes them
+    trunk, model = target.build_feature_model(model)
+    g = target.cached_validation_examples(options['features'], shard, shards, done)
+elif options.get('crops'):
+    g = target.cached_validation_examples(options['crops'], shard, shards, done)
+else:
+    g = target.validation_examples(shard, shards, done)
 
-normal_bleu1 = []
-sampled_bleu1 = []
-normal_bleu2 = []
-sampled_bleu2 = []
-normal_rouge = []
-sampled_rouge = []
-for args in g:
-    normal_score = target.evaluate(model, *args, temperature=0)
-    normal_bleu1.append(normal_score['bleu1'])
-    normal_bleu2.append(normal_score['bleu2'])
-    normal_rouge.append(normal_score['rouge'])
+# --beam=N also scores a beam search of width N
+beam_width = int(options.get('beam', 0))
 
-    SAMPLES = 10
-    sample = []
+
+def summary(scores):
+    return {
+        'candidate': scores['candidate'],
+        'likelihood': float(scores['likelihood']),
+        'bleu1': float(scores['bleu1']),
+        'bleu2': float(scores['bleu2']),
+        'rouge': float(scores['rouge']),
+    }
+
+
+def record(annotation_id, normal_score, samples, beam_score=None):
     max_likelihood = 0
     max_likelihood_sample = None
-    for i in range(SAMPLES):
-        s = target.evaluate(model, *args, temperature=.1*i)
+    for s in samples:
         if s['likelihood'] > max_likelihood:
             max_likelihood_sample = s
             max_likelihood = s['likelihood']
-    print "best sample: {} {}".format(max_likelihood, max_likelihood_sample)
-    sampled_bleu1.append(max_likelihood_sample['bleu1'])
-    sampled_bleu2.append(max_likelihood_sample['bleu2'])
-    sampled_rouge.append(max_likelihood_sample['rouge'])
-
-print("Number of Captions: {}".format(len(normal_bleu2)))
-for (name, data) in [('normal BLEU1', normal_bleu1), ('normal BLEU2', normal_bleu2), ('normal ROUGE', normal_rouge), 
-        ('sampled BLEU1', sampled_bleu1), ('sampled BLEU2', sampled_bleu2), ('sampled ROUGE', sampled_rouge)]:
-    print '{} min/max/mean'.format(name)
-    print np.array(data).min(), np.array(data).max(), np.array(data).mean()
+    print("best sample: {} {}".format(max_likelihood, max_likelihood_sample))
+
+    result = {
+        'annotation_id': annotation_id,
+        'normal': summary(normal_score),
+        'sampled': summary(max_likelihood_sample),
+    }
+    if beam_score is not None:
+        result['beam'] = summary(beam_score)
+    results_file.write(json.dumps(result) + '\n')
+    results_file.flush()
+
+
+def evaluate_sequential(g):
+    # One annotation and one temperature at a time
+    for annotation_id, args in g:
+        normal_score = target.evaluate(model, *args, temperature=0)
+        samples = [target.evaluate(model, *args, temperature=t) for t in target.SAMPLE_TEMPERATURES]
+        beam_score = target.evaluate(model, *args, beam_width=beam_width) if beam_width else None
+        record(annotation_id, normal_score, samples, beam_score)
+
+
+def evaluate_batched(g, batch_size):
+    """
+    Decodes batch_size annotations at a time, each at every temperature, in one batch.
+    The greedy caption is the sample at temperature 0.
+    Scoring runs in the pool while the next batch is decoded.
+    """
+    pending = collections.deque()
+
+    def collect(annotation_id, texts, scores):
+        for s in scores:
+            print("{} {} ({})".format(s['likelihood'], s['candidate'], texts.stripped[0]))
+        samples = scores[:len(target.SAMPLE_TEMPERATURES)]
+        record(annotation_id, samples[0], samples, scores[-1] if beam_width else None)
+
+    while True:
+        batch = list(itertools.islice(g, batch_size))
+        if not batch:
+            break
+        examples = [example for annotation_id, example in batch]
+        for (annotation_id, example), results in zip(batch, target.evaluate_batch(model, examples, beam_width=beam_width)):
+            texts = example[4]
+            pending.append((annotation_id, texts, pool.apply_async(target.score_all, (results, texts))))
+        while pending and pending[0][2].ready():
+            annotation_id, texts, result = pending.popleft()
+            collect(annotation_id, texts, result.get())
+    while pending:
+        annotation_id, texts, result = pending.popleft()
+        collect(annotation_id, texts, result.get())
+
+
+if options.get('sequential') is not None:
+    evaluate_sequential(g)
+else:
+    evaluate_batched(g, int(options.get('batch-size', BATCH_SIZE)))
+    pool.close()
+results_file.close()
+
+report(read_results([results_filename]))
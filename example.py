@@ -19,7 +19,7 @@ def draw_box(img, box, color=1.0):
 jpg, box, text = dataset_grefexp.example()
 pixels = decode_jpg(jpg, preprocess=False)
 draw_box(pixels, box)
-with open('/tmp/example.jpg', 'w') as fp:
+with open('/tmp/example.jpg', 'wb') as fp:
     fp.write(encode_jpg(pixels))
 os.system('imgcat /tmp/example.jpg')
 print(text)
@@ -0,0 +1,102 @@
+"""
+Incremental reader for the large COCO and gRefExp annotation files.
+
+json.load on instances_train2014.json builds several GB of Python objects,
+most of which the loaders throw away. iter_array walks a single top-level
+array of a JSON object one record at a time, so only the current record
+is ever held in memory. Other top-level values are parsed element by
+element and discarded.
+"""
+import json
+import re
+
+CHUNK_SIZE = 2**20
+
+decoder = json.JSONDecoder()
+whitespace = re.compile(r'[ \t\n\r]*')
+
+
+class Reader(object):
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+
+    def fill(self):
+        # Read at least as much as is buffered, so records larger than
+        # chunk_size are re-parsed a logarithmic number of times
+        data = self.fp.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return len(data) > 0
+
+    def peek(self):
+        # Returns the next non-whitespace character without consuming it
+        while True:
+            self.pos = whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON input')
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected {} at offset {}, found {}'.format(char, self.pos, found))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            # A number at the end of the buffer may have been cut in half
+            if end == len(self.buf) and self.fill():
+                continue
+            self.pos = end
+            return obj
+
+    def items(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError('Expected , or ] at offset {}, found {}'.format(self.pos - 1, separator))
+
+
+def iter_array(filename, key, chunk_size=CHUNK_SIZE):
+    """
+    Yields each element of the array stored under the top-level key
+    of the JSON object in filename, eg. iter_array(f, 'annotations')
+    """
+    with open(filename, encoding='utf-8') as fp:
+        reader = Reader(fp, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            raise KeyError(key)
+        while True:
+            name = reader.value()
+            reader.expect(':')
+            if reader.peek() == '[':
+                for item in reader.items():
+                    if name == key:
+                        yield item
+                if name == key:
+                    return
+            else:
+                reader.value()
+            if reader.peek() == '}':
+                raise KeyError(key)
+            reader.expect(',')
@@ -9,11 +9,18 @@ There are a few tasks we need to do in O(1) time:
 
 We accomplish this by storing each 'image' and 'annotation' JSON dict as a value in Redis.
 A training 'reference key' contains a set of all the keys for training set images
+
+The instances files are streamed one record at a time (see json_stream.py),
+so only the fields we persist are ever held in memory.
 """
 import sys
 import json
 import os
-import redis
+import time
+import itertools
+
+import datastore
+import json_stream
 
 
 KEY_COCO2014_IMAGES_TRAIN = 'dataset_coco2014_images_train'
@@ -21,20 +28,38 @@ KEY_COCO2014_IMAGES_VAL = 'dataset_coco2014_images_val'
 KEY_COCO2014_ANNOTATIONS_TRAIN = 'dataset_coco2014_annotations_train'
 KEY_COCO2014_ANNOTATIONS_VAL = 'dataset_coco2014_annotations_val'
 
+# Number of commands sent per pipeline round trip in bulk mode
+BULK_CHUNK_SIZE = 5000
+
+
+def image_record(img, img_directory):
+    return {
+        'filename': os.path.join(img_directory, img['file_name']),
+        'width': img['width'],
+        'height': img['height'],
+    }
+
+
+def annotation_record(anno):
+    return {
+        'image_id': anno['image_id'],
+        'segmentation': anno['segmentation'],
+        'area': anno['area'],
+        'iscrowd': anno['iscrowd'],
+        'bbox': anno['bbox'],
+        'category_id': anno['category_id'],
+    }
+
 
 def load_coco_images(conn, json_filename, img_directory, reference_key):
-    instances = json.load(open(json_filename))
-    images = instances['images']
-    for img in images:
+    count = 0
+    for img in json_stream.iter_array(json_filename, 'images'):
         redis_image_key = 'coco2014_img_{}'.format(img['id'])
-        value = json.dumps({
-            'filename': os.path.join(img_directory, img['file_name']),
-            'width': img['width'],
-            'height': img['height'],
-        })
+        value = json.dumps(image_record(img, img_directory))
         conn.set(redis_image_key, value)
         conn.sadd(reference_key, redis_image_key)
-    print("Added {} images to redis: {} now contains {} items".format(len(images), reference_key, conn.scard(reference_key)))
+        count += 1
+    print("Added {} images to redis: {} now contains {} items".format(count, reference_key, conn.scard(reference_key)))
 
 
 def add_annotation_to_image(conn, image_id, annotation_id):
@@ -48,31 +73,101 @@ def add_annotation_to_image(conn, image_id, annotation_id):
 
 
 def load_coco_annotations(conn, json_filename, reference_key):
-    instances = json.load(open(json_filename))
-    annotations = instances['annotations']
-    for anno in annotations:
+    count = 0
+    for anno in json_stream.iter_array(json_filename, 'annotations'):
         redis_annotation_key = 'coco2014_anno_{}'.format(anno['id'])
-        value = json.dumps({
-            'image_id': anno['image_id'],
-            'segmentation': anno['segmentation'],
-            'area': anno['area'],
-            'iscrowd': anno['iscrowd'],
-            'bbox': anno['bbox'],
-            'category_id': anno['category_id'],
-        })
+        value = json.dumps(annotation_record(anno))
         conn.set(redis_annotation_key, value)
         conn.sadd(reference_key, redis_annotation_key)
         add_annotation_to_image(conn, anno['image_id'], anno['id'])
-    print("Added {} annotations to redis: {} now contains {} items".format(len(annotations), reference_key, conn.scard(reference_key)))
+        count += 1
+    print("Added {} annotations to redis: {} now contains {} items".format(count, reference_key, conn.scard(reference_key)))
+
+
+def chunks(items, size=BULK_CHUNK_SIZE):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def report_throughput(count, noun, reference_key, conn, start_time):
+    elapsed = max(time.time() - start_time, 1e-6)
+    print("Added {} {} to redis in {:.1f}s ({:.0f}/s): {} now contains {} items".format(
+        count, noun, elapsed, count / elapsed, reference_key, conn.scard(reference_key)))
 
 
-def main(data_dir, conn):
+def bulk_load_coco_images(conn, json_filename, img_directory, reference_key, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Same key layout as load_coco_images, but written through non-transactional
+    pipelines of chunk_size images, with one SADD per chunk.
+    Annotation lists already attached to an image are preserved.
+    """
+    start_time = time.time()
+    count = 0
+    for chunk in chunks(json_stream.iter_array(json_filename, 'images'), chunk_size):
+        keys = ['coco2014_img_{}'.format(img['id']) for img in chunk]
+        existing = conn.mget(keys)
+        pipe = conn.pipeline(transaction=False)
+        for key, img, old_value in zip(keys, chunk, existing):
+            value = image_record(img, img_directory)
+            if old_value is not None:
+                old_annotations = json.loads(old_value).get('annotations')
+                if old_annotations is not None:
+                    value['annotations'] = old_annotations
+            pipe.set(key, json.dumps(value))
+        pipe.sadd(reference_key, *keys)
+        pipe.execute()
+        count += len(chunk)
+    report_throughput(count, 'images', reference_key, conn, start_time)
+
+
+def bulk_load_coco_annotations(conn, json_filename, reference_key, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Same key layout as load_coco_annotations, but annotations are grouped by
+    image in memory so each image blob is read and rewritten once per load
+    instead of once per annotation.
+    """
+    start_time = time.time()
+    count = 0
+    annotations_by_image = {}
+    for chunk in chunks(json_stream.iter_array(json_filename, 'annotations'), chunk_size):
+        keys = []
+        pipe = conn.pipeline(transaction=False)
+        for anno in chunk:
+            redis_annotation_key = 'coco2014_anno_{}'.format(anno['id'])
+            value = json.dumps(annotation_record(anno))
+            pipe.set(redis_annotation_key, value)
+            keys.append(redis_annotation_key)
+            annotations_by_image.setdefault(anno['image_id'], []).append(anno['id'])
+        pipe.sadd(reference_key, *keys)
+        pipe.execute()
+        count += len(chunk)
+
+    image_ids = list(annotations_by_image)
+    for chunk in chunks(image_ids, chunk_size):
+        img_keys = ['coco2014_img_{}'.format(image_id) for image_id in chunk]
+        pipe = conn.pipeline(transaction=False)
+        for img_key, image_id, value in zip(img_keys, chunk, conn.mget(img_keys)):
+            img = json.loads(value)
+            # Merge with any existing annotations to keep this process idempotent
+            img['annotations'] = list(set(img.get('annotations', []) + annotations_by_image[image_id]))
+            pipe.set(img_key, json.dumps(img))
+        pipe.execute()
+    report_throughput(count, 'annotations', reference_key, conn, start_time)
+
+
+def main(data_dir, conn, bulk=False):
     os.chdir(data_dir)
     print("Loading COCO metadata to Redis...")
-    load_coco_images(conn, 'coco/annotations/instances_train2014.json', 'coco/train2014', KEY_COCO2014_IMAGES_TRAIN)
-    load_coco_annotations(conn, 'coco/annotations/instances_train2014.json', KEY_COCO2014_ANNOTATIONS_TRAIN)
-    load_coco_images(conn, 'coco/annotations/instances_val2014.json', 'coco/val2014', KEY_COCO2014_IMAGES_VAL)
-    load_coco_annotations(conn, 'coco/annotations/instances_val2014.json', KEY_COCO2014_ANNOTATIONS_VAL)
+    images = bulk_load_coco_images if bulk else load_coco_images
+    annotations = bulk_load_coco_annotations if bulk else load_coco_annotations
+    images(conn, 'coco/annotations/instances_train2014.json', 'coco/train2014', KEY_COCO2014_IMAGES_TRAIN)
+    annotations(conn, 'coco/annotations/instances_train2014.json', KEY_COCO2014_ANNOTATIONS_TRAIN)
+    images(conn, 'coco/annotations/instances_val2014.json', 'coco/val2014', KEY_COCO2014_IMAGES_VAL)
+    annotations(conn, 'coco/annotations/instances_val2014.json', KEY_COCO2014_ANNOTATIONS_VAL)
     print("Finished loading COCO into Redis")
 
 
@@ -103,13 +198,66 @@ def test_coco_images(data_dir, conn):
     print("Tests complete!")
 
 
+def test_bulk_loader(conn):
+    # Run against a scratch database, eg. a local Redis on an unused db or fakeredis
+    import tempfile
+    instances = {
+        'images': [
+            {'id': 1, 'file_name': 'a.jpg', 'width': 640, 'height': 480},
+            {'id': 2, 'file_name': 'b.jpg', 'width': 320, 'height': 240},
+        ],
+        'annotations': [
+            {'id': 10, 'image_id': 1, 'segmentation': [], 'area': 1.0, 'iscrowd': 0, 'bbox': [0, 0, 1, 1], 'category_id': 1},
+            {'id': 11, 'image_id': 1, 'segmentation': [], 'area': 2.0, 'iscrowd': 0, 'bbox': [1, 1, 2, 2], 'category_id': 2},
+            {'id': 12, 'image_id': 2, 'segmentation': [], 'area': 3.0, 'iscrowd': 0, 'bbox': [2, 2, 3, 3], 'category_id': 3},
+        ],
+    }
+    json_filename = os.path.join(tempfile.mkdtemp(), 'instances.json')
+    with open(json_filename, 'w') as fp:
+        json.dump(instances, fp)
+
+    def snapshot():
+        return {key: json.loads(conn.get(key)) for key in conn.keys('coco2014_*')}
+
+    conn.flushdb()
+    load_coco_images(conn, json_filename, 'train', KEY_COCO2014_IMAGES_TRAIN)
+    load_coco_annotations(conn, json_filename, KEY_COCO2014_ANNOTATIONS_TRAIN)
+    serial = snapshot()
+    serial_members = conn.smembers(KEY_COCO2014_ANNOTATIONS_TRAIN)
+
+    # Loading twice must give the same result as loading once
+    conn.flushdb()
+    for _ in range(2):
+        bulk_load_coco_images(conn, json_filename, 'train', KEY_COCO2014_IMAGES_TRAIN, chunk_size=1)
+        bulk_load_coco_annotations(conn, json_filename, KEY_COCO2014_ANNOTATIONS_TRAIN, chunk_size=2)
+    bulk = snapshot()
+    for value in list(serial.values()) + list(bulk.values()):
+        if 'annotations' in value:
+            value['annotations'].sort()
+    assert bulk == serial
+    assert conn.smembers(KEY_COCO2014_ANNOTATIONS_TRAIN) == serial_members
+    assert conn.scard(KEY_COCO2014_IMAGES_TRAIN) == 2
+    conn.flushdb()
+    print("Bulk loader tests complete!")
+
+
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: {} /path/to/datasets [--test]".format(sys.argv[0]))
+    # Redis is configured with --redis-host etc., see datastore.py
+    args, options = datastore.parse_options(sys.argv[1:])
+    if 'test-bulk' in options:
+        # The test flushes its database
+        options['redis-db'] = args[0] if args else '15'
+        datastore.configure(options)
+        test_bulk_loader(datastore.get_conn())
+        exit()
+    if len(args) < 1:
+        print("Usage: {} /path/to/datasets [--test] [--bulk]".format(sys.argv[0]))
+        print("       {} --test-bulk [redis_db]".format(sys.argv[0]))
         exit()
-    data_dir = sys.argv[1]
-    conn = redis.StrictRedis()
-    if '--test' not in sys.argv:
-        main(data_dir, conn)
+    datastore.configure(options)
+    data_dir = args[0]
+    conn = datastore.get_conn()
+    if 'test' not in options:
+        main(data_dir, conn, bulk='bulk' in options)
     test_coco_images(data_dir, conn)
 
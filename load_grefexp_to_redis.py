@@ -1,17 +1,21 @@
-import redis
 import json
 import os
 import sys
 
+import datastore
+import json_stream
+import util
+import words
+from dataset_grefexp import encode_token_ids, decode_token_ids
+
 KEY_GREFEXP_TRAIN = 'dataset_grefexp_train'
 KEY_GREFEXP_VAL = 'dataset_grefexp_val'
 
 def load_refexp_to_redis(conn, refexp_file, reference_key):
-    grefexp = json.load(open(refexp_file))
-
     # First create a lookup table to refer to refexps by id
+    # Both arrays are streamed, so only the persisted fields are kept in memory
     refexps = {}
-    for r in grefexp['refexps']:
+    for r in json_stream.iter_array(refexp_file, 'refexps'):
         key = r['refexp_id']
         refexps[key] = {
             'tokens': r['tokens'],
@@ -20,16 +24,28 @@ def load_refexp_to_redis(conn, refexp_file, reference_key):
         }
 
     # Now save a json dict in Redis for each annotation
-    for a in grefexp['annotations']:
-        key = 'grefexp_{}'.format(a['annotation_id'])
-        value = json.dumps({
-            'annotation_id': a['annotation_id'],
-            'region_candidates': a['region_candidates'],
-            'refexps': [refexps[i] for i in a['refexp_ids']],
-        })
-        conn.set(key, value)
-        conn.sadd(reference_key, key)
-    count = len(grefexp['annotations'])
+    # Each refexp is also stored stripped and as token ids, so training and
+    # evaluation never have to process the raw text again
+    def annotations():
+        for a in json_stream.iter_array(refexp_file, 'annotations'):
+            key = 'grefexp_{}'.format(a['annotation_id'])
+            annotation_refexps = [refexps[i] for i in a['refexp_ids']]
+            stripped = [util.strip(r['raw']) for r in annotation_refexps]
+            yield key, json.dumps({
+                'annotation_id': a['annotation_id'],
+                'region_candidates': a['region_candidates'],
+                'refexps': annotation_refexps,
+                'stripped': stripped,
+                'token_ids': encode_token_ids(stripped),
+            })
+
+    def add(pipe, annotation):
+        key, value = annotation
+        pipe.set(key, value)
+        pipe.sadd(reference_key, key)
+
+    # One SET and one SADD per annotation
+    count = len(datastore.pipelined(annotations(), add, conn=conn)) // 2
     print("Uploaded {} annotations: {} now contains {} items".format(count, reference_key, conn.scard(reference_key)))
 
 
@@ -51,6 +67,11 @@ def test_grefexp(conn):
     assert conn.get(random_key)
     grefexp_anno = json.loads(conn.get(random_key))
 
+    # Each refexp should be stored stripped and tokenized
+    assert grefexp_anno['stripped'] == [util.strip(r['raw']) for r in grefexp_anno['refexps']]
+    tokens = decode_token_ids(grefexp_anno['token_ids'])
+    assert [list(t) for t in tokens] == [words.indices(text) for text in grefexp_anno['stripped']]
+
     # Each grefexp annotation should point to a valid COCO annotation
     assert 'annotation_id' in grefexp_anno
     coco_anno = conn.get('coco2014_anno_{}'.format(grefexp_anno['annotation_id']))
@@ -58,10 +79,12 @@ def test_grefexp(conn):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: {} /path/to/datasets".format(sys.argv[0]))
+    args, options = datastore.parse_options(sys.argv[1:])
+    if len(args) < 1:
+        print("Usage: {} /path/to/datasets [--redis-host=... (see datastore.py)]".format(sys.argv[0]))
         exit()
-    data_dir = sys.argv[1]
-    conn = redis.StrictRedis()
+    datastore.configure(options)
+    data_dir = args[0]
+    conn = datastore.get_conn()
     main(data_dir, conn)
     test_grefexp(conn)
@@ -0,0 +1,94 @@
+"""
+Offline preprocessing of a gRefExp split into an ArrayStore (see array_store.py).
+
+crops: the 224x224 global view and bounding box crop of every annotation,
+stored as uint8 along with the box rescaled to the global view. ImageNet
+preprocessing is left to util.imagenet_process_batch at training time.
+The train split takes about 13.5GB.
+
+features: the frozen ResNet trunk activations of both views (see
+caption.build_feature_model), stored as float16, for training and
+evaluating with only the learnable layers. The trunk is taken from the
+given checkpoint, or from the ImageNet weights. The train split takes
+about 22GB.
+
+Usage: python preprocess.py crops|features /path/to/output [train|val] [model.h5]
+Redis and the data directory are configured as described in datastore.py
+"""
+import os
+import sys
+import numpy as np
+
+import array_store
+import dataset_grefexp
+import datastore
+import util
+
+IMG_SHAPE = util.IMG_SHAPE + (3,)
+FEATURE_DTYPE = np.float16
+
+CHUNK_SIZE = 256
+
+
+def annotation_id(key):
+    return int(key.split('_')[-1])
+
+
+def build_crop_store(directory, reference_key):
+    keys = dataset_grefexp.get_all_keys(reference_key, shuffle=False)
+    writer = array_store.ArrayStoreWriter(directory, [annotation_id(k) for k in keys], {
+        'global': (IMG_SHAPE, np.uint8),
+        'local': (IMG_SHAPE, np.uint8),
+        'box': ((4,), np.float64),
+    })
+    for i in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[i:i + CHUNK_SIZE]
+        for key, (jpg_data, box, texts) in zip(chunk, dataset_grefexp.get_annotations_for_keys(chunk)):
+            x_global, x_local, box = util.decode_views(jpg_data, box, normalize=False)
+            writer.write(annotation_id(key), texts, **{'global': x_global, 'local': x_local, 'box': box})
+        print("Preprocessed {}/{} annotations".format(i + len(chunk), len(keys)))
+    writer.close()
+
+
+def build_feature_store(directory, reference_key, model_filename=None):
+    # Keras is only needed for feature stores
+    import caption
+    model = caption.build_model()
+    if model_filename:
+        model.load_weights(model_filename)
+    trunk, _ = caption.build_feature_model(model)
+    shapes = util.as_list(trunk.output_shape)
+    fields = {'box': ((4,), np.float64)}
+    for view in ['global', 'local']:
+        for j, shape in enumerate(shapes):
+            fields['{}_{}'.format(view, j)] = (shape[1:], FEATURE_DTYPE)
+    names = ['global_{}'.format(j) for j in range(len(shapes))] + ['local_{}'.format(j) for j in range(len(shapes))]
+
+    keys = dataset_grefexp.get_all_keys(reference_key, shuffle=False)
+    writer = array_store.ArrayStoreWriter(directory, [annotation_id(k) for k in keys], fields)
+    for i in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[i:i + CHUNK_SIZE]
+        annotations = dataset_grefexp.get_annotations_for_keys(chunk)
+        views = [util.decode_views(jpg_data, box, normalize=False) for jpg_data, box, texts in annotations]
+        features = caption.encode_images(trunk, [[x_global, x_local] for x_global, x_local, box in views])
+        for key, (jpg_data, box, texts), view, feature in zip(chunk, annotations, views, features):
+            values = dict(zip(names, feature))
+            writer.write(annotation_id(key), texts, box=view[2], **values)
+        print("Preprocessed {}/{} annotations".format(i + len(chunk), len(keys)))
+    writer.close()
+
+
+if __name__ == '__main__':
+    args, options = datastore.parse_options(sys.argv[1:])
+    if len(args) < 2 or args[0] not in ['crops', 'features']:
+        print("Usage: {} crops|features /path/to/output [train|val] [model.h5]".format(sys.argv[0]))
+        exit()
+    datastore.configure(options)
+    kind = args[0]
+    split = args[2] if len(args) > 2 else 'train'
+    reference_key = 'dataset_grefexp_{}'.format(split)
+    directory = os.path.join(args[1], '{}_{}'.format(kind, split))
+    if kind == 'crops':
+        build_crop_store(directory, reference_key)
+    else:
+        build_feature_store(directory, reference_key, args[3] if len(args) > 3 else None)
@@ -33,6 +33,76 @@ def my_lcs(string, sub):
 
     return lengths[len(string)][len(sub)]
 
+# Sequences a (the references, in score_pairs) up to this many tokens go through the uint64 kernel in lcs_batch
+WORD_BITS = 64
+
+
+def lcs_bits(string, sub):
+    """
+    Same as my_lcs, with the bit-parallel algorithm of Allison and Dix (1986):
+    one bit per token of sub, and a few integer operations per token of string
+    """
+    matches = {}
+    for i, token in enumerate(sub):
+        matches[token] = matches.get(token, 0) | (1 << i)
+    mask = (1 << len(sub)) - 1
+    v = mask
+    for token in string:
+        u = v & matches.get(token, 0)
+        v = ((v + u) | (v - u)) & mask
+    return len(sub) - bin(v).count('1')
+
+
+def lcs_batch(a, b):
+    """
+    Lengths of the longest common subsequences of many pairs of token id sequences.
+    The bit-parallel algorithm of lcs_bits runs on all pairs at once in uint64,
+    for pairs where a has at most WORD_BITS tokens. Other pairs use lcs_bits.
+    :param a : list of lists of int
+    :param b : list of lists of int, as long as a
+    :returns: array of int, the LCS length of each pair
+    """
+    lengths = np.zeros(len(a), dtype=int)
+    short = [i for i in range(len(a)) if len(a[i]) <= WORD_BITS]
+    for i in set(range(len(a))) - set(short):
+        lengths[i] = lcs_bits(b[i], a[i])
+    if not short:
+        return lengths
+    a_len = np.array([len(a[i]) for i in short])
+    b_len = np.array([len(b[i]) for i in short])
+    # Padding is -1 in a and -2 in b, so it never matches
+    A = -np.ones((len(short), max(a_len.max(), 1)), dtype=np.int64)
+    B = -2 * np.ones((len(short), max(b_len.max(), 1)), dtype=np.int64)
+    for row, i in enumerate(short):
+        A[row, :len(a[i])] = a[i]
+        B[row, :len(b[i])] = b[i]
+    bits = np.left_shift(np.uint64(1), np.arange(A.shape[1], dtype=np.uint64))
+    zero = np.uint64(0)
+    v = np.full(len(short), ~zero, dtype=np.uint64)
+    for j in range(B.shape[1]):
+        m = np.bitwise_or.reduce(np.where(A == B[:, j:j+1], bits, zero), axis=1)
+        u = v & m
+        v = (v + u) | (v - u)
+    # Carries only move upwards, so the low len(a) bits are exact: each zero is a match
+    unmatched = np.unpackbits(v[:, None].view(np.uint8), axis=1).reshape(len(short), 8, 8)
+    # unpackbits is big-endian within each byte, and the uint64 is little-endian
+    unmatched = unmatched[:, :, ::-1].reshape(len(short), 64)
+    if np.dtype(np.uint64).byteorder == '>':
+        unmatched = unmatched.reshape(len(short), 8, 8)[:, ::-1].reshape(len(short), 64)
+    in_a = np.arange(64)[None, :] < a_len[:, None]
+    lengths[short] = a_len - (unmatched.astype(bool) & in_a).sum(axis=1)
+    return lengths
+
+
+def token_ids(sentences, ids=None):
+    """
+    Splits each sentence like Rouge.calc_score and interns its tokens as ints
+    """
+    if ids is None:
+        ids = {}
+    return [[ids.setdefault(token, len(ids)) for token in s.split(" ")] for s in sentences], ids
+
+
 class Rouge():
     '''
     Class for computing ROUGE-L score for a set of candidate sentences for the MS COCO test set
@@ -51,6 +121,7 @@ class Rouge():
         """
         assert(len(candidate)==1)	
         assert(len(refs)>0)         
+        # One candidate is faster with the plain LCS, calc_scores batches many
         prec = []
         rec = []
 
@@ -74,7 +145,50 @@ class Rouge():
             score = 0.0
         return score
 
-    def compute_score(self, gts, res):
+    def calc_scores(self, candidates, refs):
+        """
+        calc_score for each of many candidates against the same references, in one LCS batch
+        :param candidates: list of str : candidate sentences to be evaluated
+        :param refs: list of str : reference sentences
+        :returns scores: array of float, one ROUGE-L score per candidate
+        """
+        assert(len(refs)>0)
+        return self.score_pairs([(c, refs) for c in candidates])
+
+    def score_pairs(self, pairs):
+        """
+        :param pairs: list of (candidate, refs) : str candidate and list of str references
+        :returns scores: array of float, one ROUGE-L score per pair, exactly as calc_score
+        """
+        if not pairs:
+            return np.zeros(0)
+        ids = {}
+        token_c, token_r, owner = [], [], []
+        for i, (candidate, refs) in enumerate(pairs):
+            c, ids = token_ids([candidate], ids)
+            r, ids = token_ids(refs, ids)
+            token_c.extend(c * len(r))
+            token_r.extend(r)
+            owner.extend([i] * len(r))
+        # the reference is the first sequence given to my_lcs, and lcs_batch bit-encodes the first, a:
+        # only references longer than WORD_BITS tokens take the slow path
+        lcs = lcs_batch(token_r, token_c).astype(float)
+        owner = np.array(owner)
+        prec = lcs / np.array([len(t) for t in token_c], dtype=float)
+        rec = lcs / np.array([len(t) for t in token_r], dtype=float)
+
+        # max over the references of each pair
+        starts = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+        prec_max = np.maximum.reduceat(prec, starts)
+        rec_max = np.maximum.reduceat(rec, starts)
+
+        nonzero = (prec_max != 0) & (rec_max != 0)
+        score = np.zeros(len(pairs))
+        p, r = prec_max[nonzero], rec_max[nonzero]
+        score[nonzero] = ((1 + self.beta**2)*p*r)/(r + self.beta**2*p)
+        return score
+
+    def compute_score(self, gts, res, batch_size=10000):
         """
         Computes Rouge-L score given a set of reference and candidate sentences for the dataset
         Invoked by evaluate_captions.py 
@@ -85,21 +199,88 @@ class Rouge():
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
 
-        score = []
+        pairs = []
         for id in imgIds:
             hypo = res[id]
             ref  = gts[id]
 
-            score.append(self.calc_score(hypo, ref))
-
             # Sanity check.
             assert(type(hypo) is list)
             assert(len(hypo) == 1)
             assert(type(ref) is list)
             assert(len(ref) > 0)
 
-        average_score = np.mean(np.array(score))
-        return average_score, np.array(score)
+            pairs.append((hypo[0], ref))
+
+        score = np.concatenate([self.score_pairs(pairs[i:i+batch_size])
+            for i in range(0, len(pairs), batch_size)] or [np.zeros(0)])
+        average_score = np.mean(score)
+        return average_score, score
 
     def method(self):
         return "Rouge"
+
+
+def test_lcs():
+    """
+    lcs_bits, lcs_batch and the batched scores must match my_lcs and the original calc_score
+    """
+    import random
+    rnd = random.Random(0)
+    vocabulary = ['the', 'man', 'on', 'left', 'a', 'red', 'shirt', '']
+    def sentence(length):
+        return ' '.join(rnd.choice(vocabulary) for _ in range(length))
+    pairs = [(sentence(rnd.randint(0, 12)), [sentence(rnd.randint(0, 12)) for _ in range(rnd.randint(1, 4))])
+        for _ in range(500)]
+    pairs.append((sentence(70), [sentence(80), sentence(3)]))
+
+    rouge = Rouge()
+    scores = rouge.score_pairs(pairs)
+    for (candidate, refs), score in zip(pairs, scores):
+        token_c = candidate.split(" ")
+        prec, rec = [], []
+        for reference in refs:
+            token_r = reference.split(" ")
+            lcs = my_lcs(token_r, token_c)
+            (ids_r, ids_c), _ = token_ids([reference, candidate])
+            assert lcs == lcs_bits(token_r, token_c) == lcs_batch([ids_r], [ids_c])[0]
+            prec.append(lcs/float(len(token_c)))
+            rec.append(lcs/float(len(token_r)))
+        prec_max, rec_max = max(prec), max(rec)
+        expected = 0.0
+        if(prec_max!=0 and rec_max !=0):
+            expected = ((1 + rouge.beta**2)*prec_max*rec_max)/float(rec_max + rouge.beta**2*prec_max)
+        assert score == expected, (candidate, refs, score, expected)
+        assert rouge.calc_score([candidate], refs) == expected
+    print("ROUGE-L tests complete!")
+
+
+# ROUGE-L as computed by caption.rouge, recorded with the original Python 2 scorer
+PINNED_REFS = ['the man on the left', 'a man in a red shirt', 'man left of the zebra']
+PINNED_SCORES = [
+    ('the man on the left', 1.0),
+    ('man in red', 0.6288659793814433),
+    ('', 0.0),
+    ('a red red red shirt', 0.5366568914956013),
+    ('the zebra on the left side', 0.7393939393939394),
+    ('giraffe', 0.0),
+]
+
+
+def test_pinned_scores():
+    rouge = Rouge()
+    for test, expected in PINNED_SCORES:
+        assert rouge.calc_score([test], PINNED_REFS) == expected, test
+    scores = rouge.calc_scores([test for test, expected in PINNED_SCORES], PINNED_REFS)
+    assert list(scores) == [expected for test, expected in PINNED_SCORES]
+    assert len(rouge.calc_scores([], PINNED_REFS)) == 0 and len(rouge.score_pairs([])) == 0
+    gts = dict((i, PINNED_REFS) for i in range(len(PINNED_SCORES)))
+    res = dict((i, [test]) for i, (test, expected) in enumerate(PINNED_SCORES))
+    average, scores = rouge.compute_score(gts, res)
+    assert list(scores) == [expected for test, expected in PINNED_SCORES]
+    print("Pinned ROUGE-L tests complete!")
+
+
+if __name__ == '__main__':
+    test_lcs()
+    test_pinned_scores()
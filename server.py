@@ -0,0 +1,326 @@
+"""
+Local captioning service with dynamic batching.
+
+Requests are handled in a thread each, which decodes the JPEG and hands
+the model inputs to a single batching thread. The batcher waits at most
+max_wait for more requests to arrive after the first one, then captions up
+to max_batch of them together with caption.Decoder, so every word of every
+caption in the batch is produced by the same forward pass.
+
+    POST /caption  {"jpg": <base64 JPEG>, "box": [x0, x1, y0, y1], "temperature": 0}
+                   -> {"caption": ..., "likelihood": ..., "batch_size": ..., "latency": ...}
+    GET /stats     -> request latency percentiles and the histogram of batch sizes
+
+Usage:
+    python server.py model.h5 [--port=8000 | --socket=/tmp/caption.sock] [--max-batch=32] [--max-wait=20] [--windowed]
+    python server.py load http://localhost:8000 | /tmp/caption.sock [--requests=200] [--concurrency=16]
+"""
+import sys
+import json
+import time
+import queue
+import base64
+import socket
+import threading
+import collections
+import socketserver
+import http.client
+import http.server
+import urllib.parse
+import numpy as np
+
+import datastore
+import util
+
+MAX_BATCH = 32
+MAX_WAIT_MS = 20
+PORT = 8000
+STATS_WINDOW = 10000
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=STATS_WINDOW)
+        self.batch_sizes = collections.Counter()
+        self.requests = 0
+
+    def record_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes[len(latencies)] += 1
+            self.requests += len(latencies)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = dict(self.batch_sizes)
+            requests = self.requests
+        summary = {
+            'requests': requests,
+            'batches': sum(batch_sizes.values()),
+            'batch_sizes': {str(k): v for k, v in sorted(batch_sizes.items())},
+        }
+        if len(latencies):
+            summary['p50_ms'] = float(np.percentile(latencies, 50))
+            summary['p99_ms'] = float(np.percentile(latencies, 99))
+        return summary
+
+
+class Pending(object):
+    def __init__(self, x_images, x_ctx, temperature, arrived):
+        self.x_images = x_images
+        self.x_ctx = x_ctx
+        self.temperature = temperature
+        # Latency is measured from arrived, when the request was received.
+        # The batching deadline from queued, after the JPEG is decoded
+        self.arrived = arrived
+        self.queued = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Batcher(object):
+    def __init__(self, decoder, max_batch=MAX_BATCH, max_wait=MAX_WAIT_MS / 1000.):
+        self.decoder = decoder
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.stats = Stats()
+        # Keras is only needed to serve, not to generate load
+        import tensorflow as tf
+        import caption
+        self.img_ctx = caption.img_ctx
+        # Keras models are called from the batching thread, in the graph and
+        # session they were built in. Keras keeps a session per thread
+        self.graph = tf.compat.v1.get_default_graph()
+        self.session = tf.compat.v1.keras.backend.get_session()
+        for model in decoder.models:
+            model._make_predict_function()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, views, temperature=0, received=None):
+        # views from util.decode_views, decoded in the request thread instead of the batcher
+        received = received or time.time()
+        x_global, x_local, box = views
+        pending = Pending([x_global, x_local], self.img_ctx(box), temperature, received)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise RuntimeError(pending.error)
+        return pending.result
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].queued + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        with self.graph.as_default(), self.session.as_default():
+            while True:
+                batch = self.next_batch()
+                try:
+                    x_images = [np.stack(x) for x in zip(*[p.x_images for p in batch])]
+                    x_ctx = np.stack([p.x_ctx for p in batch])
+                    temperatures = np.array([p.temperature for p in batch], dtype=float)
+                    captions, likelihoods = self.decoder.decode(x_images, x_ctx, temperatures)
+                except Exception as e:
+                    for pending in batch:
+                        pending.error = repr(e)
+                        pending.done.set()
+                    continue
+                finished = time.time()
+                for pending, caption, likelihood in zip(batch, captions, likelihoods):
+                    pending.result = {
+                        'caption': util.strip(caption),
+                        'likelihood': float(likelihood),
+                        'batch_size': len(batch),
+                        'latency': finished - pending.arrived,
+                    }
+                    pending.done.set()
+                self.stats.record_batch([finished - p.arrived for p in batch])
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Keep connections open between requests from the same client
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.reply(200, self.server.batcher.stats.summary())
+        else:
+            self.reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        received = time.time()
+        if self.path != '/caption':
+            return self.reply(404, {'error': 'Not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            jpg_data = base64.b64decode(request['jpg'])
+            box = tuple(float(v) for v in request['box'])
+            if len(box) != 4:
+                raise ValueError("box must be [x0, x1, y0, y1]")
+            temperature = float(request.get('temperature', 0))
+            # An image PIL can't decode (OSError) or a box it can't crop to (ValueError) is the client's error too
+            views = util.decode_views(jpg_data, box)
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            return self.reply(400, {'error': repr(e)})
+        try:
+            self.reply(200, self.server.batcher.submit(views, temperature, received))
+        except Exception as e:
+            self.reply(500, {'error': str(e)})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # One line per request would drown out everything else under load
+        pass
+
+
+class HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class UnixHTTPServer(HTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        http.client.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def connect(address):
+    # address is either http://host:port or the path of a Unix socket
+    if address.startswith('http://'):
+        url = urllib.parse.urlparse(address)
+        return http.client.HTTPConnection(url.hostname, url.port or 80)
+    return UnixHTTPConnection(address)
+
+
+def call(conn, method, path, body=None):
+    data = json.dumps(body) if body is not None else None
+    conn.request(method, path, data, {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    result = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError('{} {}: {}'.format(response.status, path, result.get('error')))
+    return result
+
+
+def request_caption(conn, jpg_data, box, temperature=0):
+    return call(conn, 'POST', '/caption', {
+        'jpg': base64.b64encode(jpg_data).decode('ascii'),
+        'box': list(box),
+        'temperature': temperature,
+    })
+
+
+def serve(model_filename, port=PORT, socket_path=None, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS, windowed=False):
+    import caption
+    # Decodes with caption.predict_windowed, one caption at a time
+    caption.windowed = windowed
+    model = caption.build_model()
+    model.load_weights(model_filename)
+    batcher = Batcher(caption.get_decoder(model), max_batch, max_wait_ms / 1000.)
+    if socket_path:
+        server = UnixHTTPServer(socket_path, Handler)
+    else:
+        server = HTTPServer(('', port), Handler)
+    server.batcher = batcher
+    print("Serving captions on {}".format(socket_path or 'port {}'.format(port)))
+    server.serve_forever()
+
+
+def load_test(address, requests=200, concurrency=16):
+    """
+    Sends requests from concurrency threads, each with its own connection,
+    captioning the center of the demo images
+    """
+    images = []
+    for filename in ['cat.jpg', 'dog.jpg', 'horse.jpg', 'car.jpg']:
+        with open(filename, 'rb') as fp:
+            jpg_data = fp.read()
+        width, height = util.open_jpg(jpg_data).size
+        images.append((jpg_data, (width * .25, width * .75, height * .25, height * .75)))
+
+    counter = iter(range(requests))
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def client():
+        conn = connect(address)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            jpg_data, box = images[i % len(images)]
+            start = time.time()
+            try:
+                request_caption(conn, jpg_data, box)
+            except Exception as e:
+                errors.append(repr(e))
+                conn = connect(address)
+                continue
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    print("{} requests in {:.2f}s from {} clients: {:.1f} requests/s, {} errors".format(
+        len(latencies), elapsed, concurrency, len(latencies) / elapsed, len(errors)))
+    if latencies:
+        latencies = np.array(latencies) * 1000
+        print("Client latency p50 {:.1f}ms p99 {:.1f}ms".format(
+            np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    print("Server stats: {}".format(json.dumps(call(connect(address), 'GET', '/stats'), sort_keys=True)))
+    for error in errors[:5]:
+        print(error)
+
+
+if __name__ == '__main__':
+    args, options = datastore.parse_options(sys.argv[1:])
+    if len(args) == 2 and args[0] == 'load':
+        load_test(args[1], int(options.get('requests', 200)), int(options.get('concurrency', 16)))
+    elif len(args) == 1:
+        serve(args[0],
+            port=int(options.get('port', PORT)),
+            socket_path=options.get('socket'),
+            max_batch=int(options.get('max-batch', MAX_BATCH)),
+            max_wait_ms=float(options.get('max-wait', MAX_WAIT_MS)),
+            windowed='windowed' in options)
+    else:
+        print(__doc__)
@@ -0,0 +1,224 @@
+"""
+Packed shard format for a gRefExp split, an alternative to Redis plus loose COCO JPEGs.
+
+A shard directory contains:
+    shard-00000.bin, shard-00001.bin, ...
+        Append-only files of concatenated records. Each record is the JPEG bytes,
+        followed by the int32 token indices of every refexp (each starting with
+        words.START_TOKEN_IDX), followed by the raw refexps as a JSON list.
+    index.npy
+        One INDEX_DTYPE row per annotation, memory-mapped at read time.
+
+Records are packed in a shuffled order, so reading a shard front to back is
+both sequential on disk and a random sample of the split.
+
+Usage: python shards.py /path/to/output [train|val]
+       python shards.py --test
+Redis and the data directory are configured as described in datastore.py
+"""
+import os
+import sys
+import json
+import numpy as np
+
+SHARD_BYTES = 2**30
+INDEX_FILENAME = 'index.npy'
+SHARD_FILENAME = 'shard-{:05d}.bin'
+
+INDEX_DTYPE = np.dtype([
+    ('annotation_id', '<i8'),
+    ('shard', '<u4'),
+    ('offset', '<u8'),
+    ('jpg_len', '<u4'),
+    ('tokens_len', '<u4'),
+    ('texts_len', '<u4'),
+    ('box', '<f8', (4,)),
+    ('category_id', '<i4'),
+])
+
+
+def write_shards(directory, records, shard_bytes=SHARD_BYTES):
+    """
+    records yields (annotation_id, jpg_data, box, category_id, texts, tokens)
+    where tokens is a list of token index lists, one per text
+    """
+    import words
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    rows = []
+    shard, offset, fp = -1, 0, None
+    for annotation_id, jpg_data, box, category_id, texts, tokens in records:
+        if fp is None or offset >= shard_bytes:
+            if fp is not None:
+                fp.close()
+            shard, offset = shard + 1, 0
+            fp = open(os.path.join(directory, SHARD_FILENAME.format(shard)), 'wb')
+        # An annotation without refexps has no token data
+        tokens_data = words.pack(tokens)
+        texts_data = json.dumps(texts).encode('utf-8')
+        fp.write(jpg_data)
+        fp.write(tokens_data)
+        fp.write(texts_data)
+        rows.append((annotation_id, shard, offset, len(jpg_data), len(tokens_data), len(texts_data), box, category_id))
+        offset += len(jpg_data) + len(tokens_data) + len(texts_data)
+    if fp is not None:
+        fp.close()
+    # The index is written last, so a partially written directory is never readable
+    np.save(os.path.join(directory, INDEX_FILENAME), np.array(rows, dtype=INDEX_DTYPE))
+    print("Packed {} annotations into {} shards in {}".format(len(rows), shard + 1, directory))
+
+
+def exists(directory):
+    # Whether a complete set of shards was written to directory
+    return os.path.exists(os.path.join(directory, INDEX_FILENAME))
+
+
+class ShardReader(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = np.load(os.path.join(directory, INDEX_FILENAME), mmap_mode='r')
+        self.annotation_ids = np.array(self.index['annotation_id'])
+        self.order = np.argsort(self.annotation_ids)
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, annotation_id):
+        return self.position(annotation_id) is not None
+
+    def position(self, annotation_id):
+        i = np.searchsorted(self.annotation_ids, annotation_id, sorter=self.order)
+        if i < len(self.order) and self.annotation_ids[self.order[i]] == annotation_id:
+            return self.order[i]
+        return None
+
+    def shard(self, number):
+        if number not in self.shards:
+            filename = os.path.join(self.directory, SHARD_FILENAME.format(number))
+            self.shards[number] = np.memmap(filename, dtype=np.uint8, mode='r')
+        return self.shards[number]
+
+    def record(self, position):
+        # Slices are views into the memory-mapped shard, nothing is copied
+        row = self.index[position]
+        data = self.shard(int(row['shard']))
+        start = int(row['offset'])
+        jpg_end = start + int(row['jpg_len'])
+        tokens_end = jpg_end + int(row['tokens_len'])
+        texts_end = tokens_end + int(row['texts_len'])
+        jpg_data = data[start:jpg_end]
+        tokens = data[jpg_end:tokens_end].view('<i4')
+        texts = json.loads(data[tokens_end:texts_end].tobytes().decode('utf-8'))
+        box = tuple(float(v) for v in row['box'])
+        return jpg_data, box, texts, tokens, int(row['category_id'])
+
+    def get_annotation(self, annotation_id):
+        position = self.position(annotation_id)
+        if position is None:
+            raise KeyError(annotation_id)
+        return self.annotation(position)
+
+    def annotation(self, position):
+        # (jpg_data, box, texts) like dataset_grefexp.get_annotation_for_key
+        jpg_data, box, texts, tokens, category_id = self.record(position)
+        import dataset_grefexp
+        import words
+        return jpg_data, box, dataset_grefexp.Refexps(texts, tokens=words.unpack(tokens))
+
+    def epoch(self, seed=None, part=0, parts=1):
+        """
+        Positions of every record in part of parts, a contiguous range of the
+        shard files, visiting shards in a random order and each one front to back
+        """
+        rng = np.random.RandomState(seed)
+        bounds = np.linspace(0, len(self), parts + 1).astype(np.int64)
+        start, end = bounds[part], bounds[part + 1]
+        # Records are indexed in the order they were written, so positions follow the files
+        shards = np.asarray(self.index['shard'][start:end])
+        for number in rng.permutation(np.unique(shards)):
+            for position in np.flatnonzero(shards == number):
+                yield start + position
+
+    def annotations(self, seed=None, part=0, parts=1):
+        # One epoch after another, forever
+        epoch = 0
+        while True:
+            for position in self.epoch(None if seed is None else seed + epoch, part, parts):
+                yield self.annotation(position)
+            epoch += 1
+
+
+def main(directory, reference_key):
+    import datastore
+    import dataset_grefexp
+    import words
+    import util
+    PACK_CHUNK = 256
+
+    keys = list(dataset_grefexp.SampleIndex.load(reference_key, seed=0).epoch())
+
+    def records():
+        for i in range(0, len(keys), PACK_CHUNK):
+            chunk = keys[i:i + PACK_CHUNK]
+            for key, record in zip(chunk, dataset_grefexp.get_joined_records(chunk)):
+                filename = datastore.data_path(record['filename'])
+                with open(filename, 'rb') as fp:
+                    jpg_data = fp.read()
+                box = dataset_grefexp.bbox_to_box(record['bbox'])
+                texts = record['texts']
+                tokens = words.vocabulary.encode_batch([util.strip(text) for text in texts])
+                annotation_id = int(key.split('_')[-1])
+                yield annotation_id, jpg_data, box, record['category_id'], texts, tokens
+
+    write_shards(directory, records())
+
+
+def test_shards():
+    # Only the val split is packed, in shards of two records each
+    import tempfile
+    import datastore
+    import dataset_grefexp
+    root = tempfile.mkdtemp()
+    with open('cat.jpg', 'rb') as fp:
+        jpg_data = fp.read()
+    records = [(i, jpg_data, (0, 1, 0, 1), 1, ['text {}'.format(i)], [[2, i, 3]]) for i in range(7)]
+    records[6] = (6, jpg_data, (0, 1, 0, 1), 1, [], [])
+    write_shards(os.path.join(root, dataset_grefexp.KEY_GREFEXP_VAL), records, shard_bytes=len(jpg_data) * 3 // 2)
+    saved = datastore.settings['shard-dir']
+    datastore.settings['shard-dir'] = root
+    try:
+        jpg, box, texts = dataset_grefexp.get_annotation_for_key('grefexp_5')
+        assert texts == ['text 5'] and jpg.tobytes() == jpg_data
+        assert [t.tolist() for t in texts.tokens] == [[2, 5, 3]]
+        jpg, box, texts = dataset_grefexp.get_annotation_for_key('grefexp_6')
+        assert texts == [] and texts.tokens == []
+    finally:
+        datastore.settings['shard-dir'] = saved
+
+    # Each part is a contiguous range of records, read a shard at a time front to back
+    reader = ShardReader(os.path.join(root, dataset_grefexp.KEY_GREFEXP_VAL))
+    parts = [list(reader.epoch(seed=1, part=part, parts=3)) for part in range(3)]
+    assert sorted(p for part in parts for p in part) == list(range(7))
+    for part in parts:
+        assert max(part) - min(part) == len(part) - 1
+        for a, b in zip(part, part[1:]):
+            assert b > a or reader.index['shard'][b] != reader.index['shard'][a]
+    stream = reader.annotations(part=1, parts=3)
+    assert sorted(next(stream)[2][0] for _ in range(4)) == ['text 2', 'text 2', 'text 3', 'text 3']
+    print("Shard tests complete!")
+
+
+if __name__ == '__main__':
+    import datastore
+    args, options = datastore.parse_options(sys.argv[1:])
+    if 'test' in options:
+        test_shards()
+        exit()
+    if len(args) < 1:
+        print("Usage: {} /path/to/output [train|val]".format(sys.argv[0]))
+        exit()
+    datastore.configure(options)
+    split = args[1] if len(args) > 1 else 'train'
+    reference_key = 'dataset_grefexp_{}'.format(split)
+    main(os.path.join(args[0], reference_key), reference_key)
@@ -0,0 +1,90 @@
+"""
+Startup time of each entry point.
+
+Every measurement runs in a fresh interpreter, which imports the modules an
+entry point needs before it does any work. The import time and the whole
+process time are reported, along with any heavy dependency that the imports
+pulled in. The deferred dependencies are then timed on their own. That is
+the cost paid at the first model build or the first Redis access instead of
+at startup.
+
+Usage: python startup_benchmark.py [--repeat=5]
+"""
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+
+import datastore
+
+ENTRY_POINTS = [
+    # entry point, the modules it imports before doing any work
+    ('train.py, evaluate.py', ['caption']),
+    ('server.py', ['server']),
+    ('preprocess.py', ['preprocess']),
+    ('example.py', ['dataset_grefexp', 'util']),
+    ('shards.py', ['shards']),
+    ('load_coco_to_redis.py', ['load_coco_to_redis']),
+    ('load_grefexp_to_redis.py', ['load_grefexp_to_redis']),
+]
+
+DEFERRED = ['keras', 'tensorflow', 'redis']
+
+MEASURE = """
+import sys, time, json, importlib
+start = time.perf_counter()
+error = None
+try:
+    for name in sys.argv[1:]:
+        importlib.import_module(name)
+except Exception as e:
+    error = repr(e)
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'error': error,
+    'loaded': [m for m in %r if m in sys.modules],
+    'vocabulary': bool(getattr(sys.modules.get('words'), 'vocabularies', None)),
+}))
+""" % (DEFERRED,)
+
+
+def measure(modules, repeat=5):
+    import_times, process_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-c', MEASURE] + modules)
+        process_times.append(time.perf_counter() - start)
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        import_times.append(result['seconds'])
+    result['import_ms'] = np.median(import_times) * 1000
+    result['process_ms'] = np.median(process_times) * 1000
+    return result
+
+
+def report(name, result):
+    notes = []
+    if result['loaded']:
+        notes.append('loads ' + ', '.join(result['loaded']))
+    if result['vocabulary']:
+        notes.append('loads the vocabulary')
+    if result['error']:
+        notes.append(result['error'])
+    print("{:<28} {:>10.1f} {:>10.1f}  {}".format(name, result['import_ms'], result['process_ms'], '; '.join(notes)))
+
+
+def main(repeat=5):
+    print("{:<28} {:>10} {:>10}".format('startup', 'import ms', 'process ms'))
+    baseline = measure([], repeat)
+    report('(empty interpreter)', baseline)
+    for name, modules in ENTRY_POINTS:
+        report(name, measure(modules, repeat))
+    print()
+    print("{:<28} {:>10} {:>10}".format('deferred until first use', 'import ms', 'process ms'))
+    for module in DEFERRED:
+        report(module, measure([module], repeat))
+
+
+if __name__ == '__main__':
+    _, options = datastore.parse_options(sys.argv[1:])
+    main(int(options.get('repeat', 5)))
@@ -2,31 +2,140 @@ import os
 import sys
 import time
 import importlib
+import subprocess
+import numpy as np
+
+import datastore
 
 # The training set contains 50k sentences
 # Each sentence contains ~10 words
 # One epoch should be around 500k, or ~100 iterations
 iter_count = 1000
 
-module_name = sys.argv[1]
+# Modes timed by --compare, the first is the baseline
+TRAINING_MODES = [
+    ('float32', False),
+    ('float32', True),
+    ('mixed_float16', False),
+    ('mixed_bfloat16', False),
+    ('mixed_bfloat16', True),
+]
+
+args, options = datastore.parse_options(sys.argv[1:])
+# --redis-host, --data-dir etc., see datastore.py
+datastore.configure(options)
+
+module_name = args[0]
 module_name = module_name.rstrip('.py')
 target = importlib.import_module(module_name)
 
+
+def compare(steps):
+    # Each mode runs in its own process, since the session options are global
+    passthrough = [arg for arg in sys.argv[1:]
+            if arg.partition('=')[0] not in ['--compare', '--benchmark', '--precision', '--xla']]
+    baseline = None
+    for precision, xla in TRAINING_MODES:
+        name = precision + (' + xla' if xla else '')
+        command = [sys.executable, sys.argv[0]] + passthrough + [
+            '--benchmark={}'.format(steps), '--precision={}'.format(precision)] + (['--xla'] if xla else [])
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        lines = [l for l in result.stdout.decode('utf-8').splitlines() if l.endswith('samples/sec')]
+        if result.returncode != 0 or not lines:
+            error = (result.stderr.decode('utf-8').strip().splitlines() or ['failed'])[-1]
+            print("{:<24} unavailable: {}".format(name, error))
+            continue
+        rate = float(lines[-1].split()[0])
+        baseline = baseline or rate
+        print("{:<24} {:>8.1f} samples/sec {:>6.2f}x".format(name, rate, rate / baseline))
+
+
+# --compare=steps reports the training throughput of every mode in TRAINING_MODES
+if options.get('compare'):
+    compare(int(options['compare']))
+    exit()
+
+# --precision=mixed_float16|mixed_bfloat16 and --xla, see caption.configure_training
+precision = options.get('precision') or 'float32'
+optimizer = 'adam'
+if precision != 'float32' or 'xla' in options:
+    optimizer = target.configure_training(precision, xla='xla' in options)
+
 model_filename = 'model.{}.{}.h5'.format(module_name, int(time.time()))
-if len(sys.argv) > 2:
-    model_filename = sys.argv[2]
+if len(args) > 1:
+    model_filename = args[1]
 
+# --windowed runs the demo with the original decoding loop, see caption.windowed
+target.windowed = 'windowed' in options
 model = target.build_model()
 if os.path.exists(model_filename):
     model.load_weights(model_filename)
 
-model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'], decay=.01, lr=.001)
+# --features trains a variant that shares all of model's layers but takes
+# frozen ResNet activations in place of images: computed once per annotation
+# during training, or read from --features=/path/to/store from preprocess.py
+trunk = None
+train_model = model
+if 'features' in options:
+    trunk, train_model = target.build_feature_model(model)
+
+# --sparse trains on word indices instead of dense one-hot targets
+sparse = 'sparse' in options
+loss = 'sparse_categorical_crossentropy' if sparse else 'categorical_crossentropy'
+train_model.compile(optimizer=optimizer, loss=loss, metrics=['accuracy'])
+
+if 'crops' in options:
+    # Preprocessed crops from preprocess.py
+    g = target.cached_training_generator(options['crops'], sparse=sparse)
+elif options.get('features'):
+    g = target.cached_training_generator(options['features'], sparse=sparse)
+elif 'expand' in options or trunk is not None:
+    # Every prefix of every refexp of each decoded annotation
+    g = target.expanded_training_generator(sparse=sparse, trunk=trunk)
+else:
+    # --workers=N builds batches in N background processes
+    g = target.training_generator(sparse=sparse, workers=int(options.get('workers', 0)))
+
+
+def synthetic_batch(batch_size=32):
+    # Random inputs and targets shaped like train_model's, so the benchmark needs no dataset
+    x = []
+    for tensor in train_model.inputs:
+        shape = (batch_size,) + tuple(tensor.shape.as_list()[1:])
+        if tensor.dtype.is_integer:
+            x.append(np.random.randint(0, 100, size=shape).astype(tensor.dtype.as_numpy_dtype))
+        else:
+            x.append(np.random.uniform(0, 255, size=shape).astype(np.float32))
+    vocabulary_size = train_model.outputs[0].shape.as_list()[-1]
+    if sparse:
+        y = np.random.randint(0, vocabulary_size, size=(batch_size, 1))
+    else:
+        y = np.eye(vocabulary_size, dtype=np.float32)[np.random.randint(0, vocabulary_size, size=batch_size)]
+    return x, y
+
+
+def benchmark(steps, warmup=3):
+    # Training steps on a few synthetic batches, so that only the steps are timed
+    batches = [synthetic_batch() for _ in range(2)]
+    for i in range(warmup):
+        train_model.train_on_batch(*batches[i % len(batches)])
+    samples = 0
+    start = time.time()
+    for i in range(steps):
+        x, y = batches[i % len(batches)]
+        train_model.train_on_batch(x, y)
+        samples += len(y)
+    return samples / (time.time() - start)
+
 
-g = target.training_generator()
+# --benchmark=steps times that many training steps in the chosen mode, without training
+if options.get('benchmark'):
+    print("{:.1f} samples/sec".format(benchmark(int(options['benchmark']))))
+    exit()
 
 for i in range(iter_count):
     samples = 2**12
-    print("Trained {}k samples:".format(i * samples / 2**10))
+    print("Trained {}k samples:".format(i * samples // 2**10))
     target.demo(model)
-    model.fit_generator(g, steps_per_epoch=100, nb_epoch=1)
+    train_model.fit_generator(g, steps_per_epoch=100, epochs=1)
     model.save_weights(model_filename)
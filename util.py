@@ -1,19 +1,27 @@
+import io
 import re
 import os
+import math
+import importlib
 import numpy as np
 from PIL import Image
-from StringIO import StringIO
 
 import words
-from words import VOCABULARY_SIZE
 
 
 IMG_SHAPE = (224,224)
 MAX_WORDS = 10
+IMAGENET_MEAN = np.array([103.939, 116.779, 123.68])
+
+# Pixels are stored and batched as uint8, and only converted to FLOAT_DTYPE
+# (in place, once per batch) right before they are fed to the model
+PIXEL_DTYPE = np.uint8
+FLOAT_DTYPE = np.float32
+INDEX_DTYPE = np.int32
 
 
 def onehot(index):
-    res = np.zeros(VOCABULARY_SIZE)
+    res = np.zeros(words.VOCABULARY_SIZE, dtype=FLOAT_DTYPE)
     res[index] = 1.0
     return res
 
@@ -22,14 +30,41 @@ def expand(x):
     return np.expand_dims(x, axis=0)
 
 
+def as_list(x):
+    return x if isinstance(x, list) else [x]
+
+
+class LazyModule(object):
+    """
+    Stands in for the module called name, which is only imported the first
+    time one of its attributes is used, eg. models = LazyModule('keras.models')
+    """
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        # Only called for attributes of the module, not name and module
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+def open_jpg(jpg):
+    if isinstance(jpg, np.ndarray):
+        # jpg is a view into a memory-mapped shard (see shards.py)
+        return Image.open(io.BytesIO(jpg))
+    elif isinstance(jpg, (bytes, bytearray, memoryview)):
+        # jpg is a JPG buffer. BytesIO shares the memory of bytes instead of copying it
+        return Image.open(io.BytesIO(jpg))
+    # jpg is a filename
+    return Image.open(jpg)
+
+
 # Swiss army knife for image decoding
-def decode_jpg(jpg, box=None, crop_to_box=None, preprocess=True):
-    if jpg.startswith('\xFF\xD8'):
-        # jpg is a JPG buffer
-        img = Image.open(StringIO(jpg))
-    else:
-        # jpg is a filename
-        img = Image.open(jpg)
+# normalize=False skips imagenet_process and returns resized uint8 pixels
+def decode_jpg(jpg, box=None, crop_to_box=None, preprocess=True, normalize=True):
+    img = open_jpg(jpg)
     img = img.convert('RGB')
     width = img.width
     height = img.height
@@ -39,39 +74,79 @@ def decode_jpg(jpg, box=None, crop_to_box=None, preprocess=True):
         img = img.crop((x0,y0,x1,y1))
     if preprocess:
         img = img.resize(IMG_SHAPE)
-    pixels = np.array(img).astype(float)
-    if preprocess:
+    pixels = to_pixels(img, normalize)
+    if preprocess and normalize:
         pixels = imagenet_process(pixels)
     if box:
-        # Transform a bounding box after resizing
-        x0, x1, y0, y1 = box
-        xs = float(pixels.shape[1]) / width
-        ys = float(pixels.shape[0]) / height
-        x0 *= xs
-        x1 *= xs
-        y0 *= ys
-        y1 *= ys
-        return pixels, (x0, x1, y0, y1)
+        return pixels, scale_box(box, pixels.shape[1], pixels.shape[0], width, height)
     return pixels
 
 
+def decode_views(jpg, box, normalize=True):
+    """
+    Decodes a JPEG once and returns the global view, the crop to box, and
+    box transformed to global view coordinates, like these two calls:
+        x_local = decode_jpg(jpg, crop_to_box=box)
+        x_global, box = decode_jpg(jpg, box)
+    The JPEG is decoded with DCT scaling at the smallest of 1/1, 1/2, 1/4
+    or 1/8 scale that still leaves both views at least IMG_SHAPE pixels.
+    """
+    img = open_jpg(jpg)
+    width, height = img.size
+    x0, x1, y0, y1 = box
+    scale = max(
+        float(IMG_SHAPE[0]) / width,
+        float(IMG_SHAPE[1]) / height,
+        float(IMG_SHAPE[0]) / max(x1 - x0, 1),
+        float(IMG_SHAPE[1]) / max(y1 - y0, 1))
+    if scale < 1:
+        img.draft('RGB', (int(math.ceil(width * scale)), int(math.ceil(height * scale))))
+    img = img.convert('RGB')
+    # Box coordinates in the (possibly reduced) decoded image
+    dx0, dx1, dy0, dy1 = scale_box(box, img.width, img.height, width, height)
+    x_local = to_pixels(img.crop((dx0,dy0,dx1,dy1)).resize(IMG_SHAPE), normalize)
+    x_global = to_pixels(img.resize(IMG_SHAPE), normalize)
+    if normalize:
+        x_local = imagenet_process(x_local)
+        x_global = imagenet_process(x_global)
+    return x_global, x_local, scale_box(box, IMG_SHAPE[0], IMG_SHAPE[1], width, height)
+
+
+def to_pixels(img, normalize=True):
+    if normalize:
+        return np.array(img, dtype=FLOAT_DTYPE)
+    return np.array(img, dtype=PIXEL_DTYPE)
+
+
+def scale_box(box, new_width, new_height, width, height):
+    # Transform a bounding box after resizing
+    x0, x1, y0, y1 = box
+    xs = float(new_width) / width
+    ys = float(new_height) / height
+    return (x0 * xs, x1 * xs, y0 * ys, y1 * ys)
+
+
 def encode_jpg(pixels):
     img = Image.fromarray(pixels.astype(np.uint8)).convert('RGB')
-    fp = StringIO()
+    fp = io.BytesIO()
     img.save(fp, format='JPEG')
     return fp.getvalue()
 
 
 def imagenet_process(x):
-    x[:, :, 0] -= 103.939
-    x[:, :, 1] -= 116.779
-    x[:, :, 2] -= 123.68
+    # Works in place on one image or a batch of float images
+    x -= IMAGENET_MEAN
     # 'RGB'->'BGR'
-    return x[:, :, ::-1]
+    return x[..., ::-1]
+
+
+def imagenet_process_batch(x):
+    # imagenet_process for a whole batch of uint8 images at once
+    return imagenet_process(x.astype(FLOAT_DTYPE))
 
 
 def left_pad(indices):
-    res = np.zeros(MAX_WORDS, dtype=int)
+    res = np.zeros(MAX_WORDS, dtype=INDEX_DTYPE)
     res[MAX_WORDS - len(indices):] = indices
     return res
 
@@ -84,7 +159,7 @@ def show(jpg, box=None):
         pixels = decode_jpg(jpg, preprocess=False)
     if box:
         draw_box(pixels, box)
-    with open('/tmp/example.jpg', 'w') as fp:
+    with open('/tmp/example.jpg', 'wb') as fp:
         fp.write(encode_jpg(pixels))
         os.system('imgcat /tmp/example.jpg')
 
@@ -111,3 +186,67 @@ def strip(text):
         text = text[:end_idx]
     # Remove non-alphanumeric characters and lowercase everything
     return re.sub(r'\W+', ' ', text.lower()).strip()
+
+
+def test_preprocess_dtypes(jpg='cat.jpg'):
+    # The uint8 -> float32 batch path must give the same model inputs as
+    # the original float64 per-image path, up to float32 rounding
+    img = Image.open(jpg).convert('RGB').resize(IMG_SHAPE)
+    expected = np.array(img).astype(np.float64)
+    expected[:, :, 0] -= 103.939
+    expected[:, :, 1] -= 116.779
+    expected[:, :, 2] -= 123.68
+    expected = expected[:, :, ::-1]
+
+    batch = np.zeros((2,) + IMG_SHAPE + (3,), dtype=PIXEL_DTYPE)
+    batch[1] = decode_jpg(jpg, normalize=False)
+    processed = imagenet_process_batch(batch)
+    assert processed.dtype == FLOAT_DTYPE
+    assert np.allclose(processed[1], expected, rtol=0, atol=1e-4)
+    single = decode_jpg(jpg)
+    assert single.dtype == FLOAT_DTYPE
+    assert np.allclose(single, expected, rtol=0, atol=1e-4)
+    print("Preprocessing tests complete!")
+
+
+def test_pinned_preprocessing():
+    # Recorded outputs of the image and text preprocessing. Pixel sums allow
+    # for small differences between JPEG decoder builds
+    pinned = [
+        # filename, decode_jpg pixel sum, decode_views local pixel sum, pixel [100, 100]
+        ('cat.jpg', 19612727, 17408902, [234, 185, 114]),
+        ('dog.jpg', 17852369, 22204248, [14, 7, 4]),
+    ]
+    for filename, global_sum, local_sum, pixel in pinned:
+        with open(filename, 'rb') as fp:
+            jpg = fp.read()
+        x = decode_jpg(filename, normalize=False)
+        assert x.shape == IMG_SHAPE + (3,) and x.dtype == PIXEL_DTYPE
+        assert np.isclose(x.astype(np.int64).sum(), global_sum, rtol=1e-3), filename
+        assert np.abs(x[100, 100].astype(int) - pixel).max() <= 2, filename
+        width, height = open_jpg(jpg).size
+        box = (width * .25, width * .75, height * .25, height * .75)
+        x_global, x_local, scaled_box = decode_views(jpg, box, normalize=False)
+        assert np.isclose(x_global.astype(np.int64).sum(), global_sum, rtol=1e-3), filename
+        assert np.isclose(x_local.astype(np.int64).sum(), local_sum, rtol=1e-3), filename
+        assert scaled_box == (56.0, 168.0, 56.0, 168.0)
+    assert strip('000 The man, on the LEFT 001 extra') == 'the man on the left'
+    assert left_pad(words.indices('the man on the left')).tolist() == [0, 0, 0, 2, 25352, 15176, 17226, 25352, 14314, 3]
+    print("Pinned preprocessing tests complete!")
+
+
+def test_lazy_module():
+    import sys
+    json_module = LazyModule('json')
+    assert json_module.loads('[1]') == [1] and json_module.module is sys.modules['json']
+    lazy = LazyModule('xml.dom.minidom')
+    assert lazy.module is None
+    assert lazy.parseString('<a/>').documentElement.tagName == 'a'
+    assert lazy.module is sys.modules['xml.dom.minidom']
+    print("Lazy module tests complete!")
+
+
+if __name__ == '__main__':
+    test_lazy_module()
+    test_preprocess_dtypes()
+    test_pinned_preprocessing()
@@ -1,20 +1,134 @@
+"""
+The caption vocabulary.
+
+Vocabulary keeps id -> word as a NumPy string array, so whole batches of
+captions are decoded with one fancy index, and word -> id as a frozen dict.
+encode_batch and decode_batch convert many captions at once.
+
+Nothing is loaded at import time: vocabulary, VOCABULARY_SIZE and
+UNKNOWN_IDX are looked up on first use (see __getattr__).
+"""
+import types
+import numpy as np
+
 START_TOKEN_IDX = 2
 END_TOKEN_IDX = 3
 
-words = open('vocabulary.txt').read().split()
-vocab = {}
-for i, word in enumerate(words):
-    vocab[i] = word
-    vocab[word] = i
+VOCABULARY_FILENAME = 'vocabulary.txt'
+
+
+class Vocabulary(object):
+    def __init__(self, words):
+        words = list(words)
+        self.words = np.asarray(words, dtype=np.str_)
+        # Lookups go through the dict itself, the proxy is only for sharing it read-only
+        self.index = dict(zip(words, range(len(words))))
+        self.ids = types.MappingProxyType(self.index)
+        self.unknown_idx = self.ids['thing']
+
+    def __len__(self):
+        return len(self.words)
+
+    @classmethod
+    def load(cls, filename=VOCABULARY_FILENAME):
+        with open(filename) as fp:
+            return cls(fp.read().split())
+
+    def encode(self, text):
+        return [self.index.get(w, self.unknown_idx) for w in tokenize(text)]
+
+    def encode_batch(self, texts):
+        """
+        Like encode for every text
+        Returns a list of int32 arrays, one per text
+        """
+        get, unknown_idx = self.index.get, self.unknown_idx
+        tokens = [tokenize(text) for text in texts]
+        # One array for all texts, returned as a view per text
+        ids = np.array([get(w, unknown_idx) for t in tokens for w in t], dtype=np.int32)
+        ends = np.cumsum([len(t) for t in tokens]).tolist()
+        return [ids[start:end] for start, end in zip([0] + ends, ends)]
+
+    def decode(self, indices):
+        return ' '.join(self.words[np.asarray(indices, dtype=np.intp)].tolist())
+
+    def decode_batch(self, indices):
+        # indices is a 2d array of ids, one row per caption
+        return [' '.join(row) for row in self.words[np.asarray(indices, dtype=np.intp)].tolist()]
+
+
+def pack(token_lists):
+    # Concatenated little-endian int32 ids. Every list starts with START_TOKEN_IDX, which marks the boundaries
+    if not len(token_lists):
+        return b''
+    return np.concatenate([np.asarray(t, dtype='<i4') for t in token_lists]).tobytes()
+
 
-VOCABULARY_SIZE = len(words)
-UNKNOWN_IDX = vocab['thing']
+def unpack(data):
+    # The token id arrays in data from pack, which may be any buffer
+    ids = np.frombuffer(data, dtype='<i4')
+    return np.split(ids, np.flatnonzero(ids == START_TOKEN_IDX)[1:]) if len(ids) else []
+
+
+def tokenize(text):
+    # Each caption starts with START_TOKEN and ends with END_TOKEN
+    return ('000 ' + text + ' 001').lower().split()
+
+
+vocabularies = {}
+
+
+def get_vocabulary(filename=VOCABULARY_FILENAME):
+    if filename not in vocabularies:
+        vocabularies[filename] = Vocabulary.load(filename)
+    return vocabularies[filename]
+
+
+def __getattr__(name):
+    # words.vocabulary etc. load the vocabulary the first time they are used
+    if name == 'vocabulary':
+        return get_vocabulary()
+    if name == 'VOCABULARY_SIZE':
+        return len(get_vocabulary())
+    if name == 'UNKNOWN_IDX':
+        return get_vocabulary().unknown_idx
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def words(indices):
-    return ' '.join(vocab[i] for i in indices)
+    return get_vocabulary().decode(indices)
 
 
 def indices(text):
-    wordlist = ('000 ' + text + ' 001').lower().split()
-    return [vocab.get(w, UNKNOWN_IDX) for w in wordlist]
+    return get_vocabulary().encode(text)
+
+
+def test_vocabulary():
+    # The encodings must match the original mixed dict, one text at a time and in batches
+    vocabulary = get_vocabulary()
+    with open(VOCABULARY_FILENAME) as fp:
+        wordlist = fp.read().split()
+    vocab = {}
+    for i, word in enumerate(wordlist):
+        vocab[i] = word
+        vocab[word] = i
+    texts = ['the man on the LEFT', '', 'a xyzzy giraffe', 'thing 000 001']
+    for text in texts:
+        expected = [vocab.get(w, vocab['thing']) for w in ('000 ' + text + ' 001').lower().split()]
+        assert indices(text) == expected, text
+        assert words(expected) == ' '.join(vocab[i] for i in expected)
+    for text, encoded in zip(texts, vocabulary.encode_batch(texts)):
+        assert encoded.dtype == np.int32 and encoded.tolist() == indices(text)
+    assert vocabulary.encode_batch([]) == []
+    rows = np.array([[0, 2, 5, 3], [3, 3, 3, 3]])
+    assert vocabulary.decode_batch(rows) == [words(row) for row in rows]
+
+    # Stripped texts never contain START_TOKEN, see util.strip
+    packed = unpack(pack(vocabulary.encode_batch(texts[:3])))
+    assert [t.tolist() for t in packed] == [indices(text) for text in texts[:3]]
+    assert vocabulary.words.tolist() == wordlist
+    print("Vocabulary tests complete!")
+
+
+if __name__ == '__main__':
+    test_vocabulary()